@@ -18,16 +18,18 @@
 g_cache = None
 
 
-def EnableGlobalCaching(timeout=1, max_channels=8):
+def EnableGlobalCaching(timeout=1, max_channels=8, close_policy=None):
     """Enable caching of ssh connections for all API calls
 
     Args:
         timeout - the length of time to keep an unused connection open.
         max_channel - the maximum number of channels to multiplex on a single ssh socket.
+        close_policy - a cache.SSHAdaptiveTimeout to use instead of timeout.
     """
     global g_cache
     from .cache import SSHConnectionCache
-    g_cache = SSHConnectionCache("SSH global connection cache", timeout, max_channels)
+    g_cache = SSHConnectionCache(
+        "SSH global connection cache", timeout, max_channels, close_policy=close_policy)
 
 
 def DisableGlobalCaching():
@@ -17,13 +17,30 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import atexit
+import binascii
+import bisect
+import collections
+import errno
+import getpass
+import heapq
+import itertools
+import json
 import logging
 import os
 import select
 import socket
+import tempfile
 import threading
+import time
 import traceback
+import weakref
 import paramiko as ssh
+try:
+    import selectors
+except ImportError:
+    # Python 2
+    import selectors2 as selectors
 
 __author__ = 'Christian Hopps'
 __date__ = 'December 14 2016'
@@ -34,44 +51,1218 @@ logger = logging.getLogger(__name__)
 # Used by travis-ci testing
 _private_key = None
 
+# Monotonic if we have it.
+_now = getattr(time, "monotonic", time.time)
+
 
 def _socket_is_remote_closed(sock):
     try:
         rfds, unused, unused = select.select([sock], [], [], 0)
     except TypeError:
         return sock.closed
+    except ValueError:
+        # Already closed locally (fileno is -1)
+        return True
 
     try:
         if sock in rfds:
-            buf = sock.recv(1, socket.MSG_PEEK)
+            # Don't block if another thread (e.g., the transport) read the data first.
+            buf = sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
             if not buf:
                 logger.debug("Read 0 PEEK after select ready -- assuming closed.")
                 return True
         return False
+    except socket.timeout:
+        return False
     except Exception as error:
+        # The data was read first, raised as socket.error (BlockingIOError in Python 3).
+        if getattr(error, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return False
         logger.debug("***** GOT EXCEPTION on read(PEEK) must be closed: sock: %s: %s", str(sock),
                      str(error))
         return True
 
 
+class SSHTimeoutError(socket.timeout):
+    """A deadline expired while opening an ssh connection.
+
+    :ivar phase: The phase that was in progress, one of `SSHDeadline.PHASES` or "command" if a
+                 command was still running (see `sshutil.cmd.run_hosts`).
+    """
+
+    def __init__(self, phase, timeout):
+        super(SSHTimeoutError, self).__init__("Timed out during {} ({}s)".format(phase, timeout))
+        self.phase = phase
+        self.timeout = timeout
+
+
+class SSHDeadline(object):
+    """A deadline for opening an ssh connection with optional budgets for each phase.
+
+    The phases are "wait" (for a cached socket or another caller's connect), "connect" (name
+    resolution and TCP connect), "handshake" (SSH key exchange), "auth" and "channel" (opening the
+    session channel). A phase times out when either its own budget or the overall deadline runs out.
+
+    :param timeout: The overall number of seconds allowed, or `None` for no limit.
+    :param phase_timeouts: A dictionary of phase name to the number of seconds allowed for that
+                           phase.
+    """
+
+    PHASES = ("wait", "connect", "handshake", "auth", "channel")
+
+    def __init__(self, timeout=None, phase_timeouts=None):
+        self.timeout = timeout
+        self.expire = None if timeout is None else _now() + timeout
+        self.phase_timeouts = dict(phase_timeouts or {})
+        for phase in self.phase_timeouts:
+            if phase not in self.PHASES:
+                raise ValueError("Unknown timeout phase: {}".format(phase))
+
+    def remaining(self, phase, started=None):
+        """Return the seconds left for `phase` or `None` if there is no limit.
+
+        :param phase: The phase to check.
+        :param started: When the phase started (see `_now`) if not now.
+        :raises: SSHTimeoutError if there is no time left.
+        """
+        now = _now()
+        remaining = self.phase_timeouts.get(phase)
+        if remaining is not None and started is not None:
+            remaining -= now - started
+        if self.expire is not None and (remaining is None or self.expire - now < remaining):
+            remaining = self.expire - now
+        if remaining is not None and remaining <= 0:
+            raise self.timed_out(phase)
+        return remaining
+
+    def timed_out(self, phase):
+        """Return the `SSHTimeoutError` to raise for `phase`."""
+        timeout = self.phase_timeouts.get(phase)
+        if timeout is None or (self.expire is not None and _now() >= self.expire):
+            timeout = self.timeout
+        return SSHTimeoutError(phase, timeout)
+
+
+# Upper bounds in seconds of the handshake latency histogram buckets.
+HANDSHAKE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+class _Histogram(object):
+    """A histogram with fixed bucket upper bounds."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        # The last count is for values over the largest bound.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Return the histogram as a dictionary with cumulative (Prometheus style) buckets."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"), ), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return dict(buckets=buckets, sum=self.sum, count=self.count)
+
+
+class _CacheStats(object):
+    """Counters kept by a cache, these are updated while holding the cache lock.
+
+    Hits and waits are also counted by each `_KeyShard` of a `SSHConnectionCache` and added in
+    when the shard is removed.
+    """
+
+    __slots__ = ("hits", "misses", "waits", "evictions", "expirations", "dead", "connect_errors",
+                 "spares", "handshake")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.dead = 0
+        self.connect_errors = 0
+        self.spares = 0
+        self.handshake = _Histogram(HANDSHAKE_BUCKETS)
+
+    def snapshot(self, shards=()):
+        """Return the counters as a dictionary including the hits and waits of `shards`"""
+        hits = self.hits
+        waits = self.waits
+        for shard in shards:
+            hits += shard.hits
+            waits += shard.waits
+        lookups = hits + self.misses
+        return dict(
+            hit_rate=hits / lookups if lookups else 0.0,
+            hits=hits,
+            misses=self.misses,
+            waits=waits,
+            evictions=self.evictions,
+            expirations=self.expirations,
+            dead=self.dead,
+            connect_errors=self.connect_errors,
+            spares=self.spares,
+            handshake_seconds=self.handshake.snapshot())
+
+
+def _escape_label(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_prometheus(stats, prefix="sshutil_cache", labels=None):
+    """Format a cache `stats()` snapshot in the Prometheus text exposition format.
+
+    :param stats: The dictionary returned by a cache's `stats` method.
+    :param prefix: The prefix for the metric names.
+    :param labels: A dictionary of labels to add to every metric (e.g., the cache name).
+    :return: The metrics as a string.
+    """
+
+    def fmt_labels(extra=None):
+        all_labels = dict(labels or {})
+        all_labels.update(extra or {})
+        if not all_labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, _escape_label(v))
+                              for k, v in sorted(all_labels.items())) + "}"
+
+    lines = []
+    for name in ("hits", "misses", "waits", "evictions", "expirations", "dead", "connect_errors",
+                 "spares"):
+        lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+        lines.append("{}_{}_total{} {}".format(prefix, name, fmt_labels(), stats[name]))
+    for name in ("hit_rate", "sockets", "channels"):
+        lines.append("# TYPE {}_{} gauge".format(prefix, name))
+        lines.append("{}_{}{} {}".format(prefix, name, fmt_labels(), stats[name]))
+    for name in ("sockets", "channels", "close_timeout"):
+        lines.append("# TYPE {}_key_{} gauge".format(prefix, name))
+        for keystats in stats["keys"]:
+            keylabels = dict(
+                host=keystats["host"], port=keystats["port"], username=keystats["username"])
+            # Keys differing only in how the host is reached must be different series.
+            if keystats.get("proxycmd"):
+                keylabels["proxy"] = keystats["proxycmd"]
+            if keystats.get("profile"):
+                keylabels["profile"] = keystats["profile"]
+            lines.append("{}_key_{}{} {}".format(prefix, name, fmt_labels(keylabels),
+                                                 keystats[name]))
+    hist = stats["handshake_seconds"]
+    name = prefix + "_handshake_seconds"
+    lines.append("# TYPE {} histogram".format(name))
+    for bound, count in hist["buckets"]:
+        le = "+Inf" if bound == float("inf") else repr(float(bound))
+        lines.append("{}_bucket{} {}".format(name, fmt_labels(dict(le=le)), count))
+    lines.append("{}_sum{} {}".format(name, fmt_labels(), hist["sum"]))
+    lines.append("{}_count{} {}".format(name, fmt_labels(), hist["count"]))
+    return "\n".join(lines) + "\n"
+
+
+class PrewarmResult(collections.namedtuple("PrewarmResult", "host port username error elapsed")):
+    """The result of prewarming a cached connection to a host.
+
+    `error` is the exception raised while connecting or `None` on success, and `elapsed` is the
+    time taken in seconds.
+    """
+    __slots__ = ()
+
+
+def _start_workers(work, concurrency, run, name, take=None):
+    """Start up to `concurrency` daemon threads calling `run(idx, item)` for each item of `work`.
+
+    :param work: A list of the work items.
+    :param concurrency: The maximum number of threads to start.
+    :param run: Called with the index and the item for each item of `work`.
+    :param name: The name of the threads.
+    :param take: If not `None` called with the index of each item when a thread takes it, holding
+                 the lock that hands out the work. The item is only run if this returns True,
+                 otherwise the thread exits.
+    :return: The threads started, join them to wait for the work to be done.
+    """
+    work_iter = iter(enumerate(work))
+    work_lock = threading.Lock()
+
+    def work_thread():
+        while True:
+            with work_lock:
+                try:
+                    idx, item = next(work_iter)
+                except StopIteration:
+                    return
+                if take is not None and not take(idx):
+                    return
+            run(idx, item)
+
+    threads = []
+    for unused in range(0, max(1, min(concurrency, len(work)))):
+        thread = threading.Thread(target=work_thread, name=name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+class SSHTransportProfile(
+        collections.namedtuple(
+            "SSHTransportProfile", "name ciphers kex macs compress window_size max_packet_size "
+            "rekey_bytes rekey_packets")):
+    """Tuning for the ssh transports opened for a connection.
+
+    The algorithm preferences are tried before the other algorithms paramiko supports, those not
+    supported are ignored. `None` leaves paramiko's default.
+
+    :ivar name: The name of the profile.
+    :ivar ciphers: Preferred ciphers.
+    :ivar kex: Preferred key exchange algorithms.
+    :ivar macs: Preferred MAC algorithms.
+    :ivar compress: True to ask for compression.
+    :ivar window_size: The receive window size of channels.
+    :ivar max_packet_size: The maximum packet size of channels.
+    :ivar rekey_bytes: Rekey after sending or receiving this many bytes.
+    :ivar rekey_packets: Rekey after sending or receiving this many packets.
+    """
+    __slots__ = ()
+
+
+SSHTransportProfile.__new__.__defaults__ = ((), (), (), False, None, None, None, None)
+
+# Named transport profiles that can be given instead of a `SSHTransportProfile`.
+TRANSPORT_PROFILES = {
+    "low-latency":
+    SSHTransportProfile(
+        "low-latency",
+        ciphers=("aes128-gcm@openssh.com", "aes128-ctr"),
+        kex=("curve25519-sha256@libssh.org", "ecdh-sha2-nistp256"),
+        macs=("hmac-sha2-256-etm@openssh.com", "hmac-sha2-256")),
+    "bulk-throughput":
+    SSHTransportProfile(
+        "bulk-throughput",
+        ciphers=("aes128-gcm@openssh.com", "aes256-gcm@openssh.com", "aes128-ctr"),
+        kex=("curve25519-sha256@libssh.org", "ecdh-sha2-nistp256"),
+        macs=("hmac-sha2-256-etm@openssh.com", "hmac-sha2-256"),
+        window_size=16 * 1024 * 1024,
+        max_packet_size=32 * 1024,
+        rekey_bytes=pow(2, 32)),
+    "constrained-device":
+    SSHTransportProfile(
+        "constrained-device",
+        ciphers=("aes128-ctr", "aes128-cbc"),
+        kex=("diffie-hellman-group14-sha256", "diffie-hellman-group14-sha1",
+             "diffie-hellman-group1-sha1"),
+        macs=("hmac-sha2-256", "hmac-sha1"),
+        compress=True,
+        window_size=256 * 1024,
+        max_packet_size=16 * 1024),
+}
+
+
+def _transport_profile(profile):
+    """Return the `SSHTransportProfile` for `profile`, possibly a name in `TRANSPORT_PROFILES`"""
+    if profile is None or isinstance(profile, SSHTransportProfile):
+        return profile
+    try:
+        return TRANSPORT_PROFILES[profile]
+    except KeyError:
+        raise ValueError("Unknown transport profile: {}".format(profile))
+
+
+def _new_transport(sock, profile):
+    """Return a new `ssh.Transport` on `sock` tuned by `profile` (which may be `None`)."""
+    if profile is None:
+        return ssh.Transport(sock)
+    kwargs = {}
+    if profile.window_size is not None:
+        kwargs["default_window_size"] = profile.window_size
+    if profile.max_packet_size is not None:
+        kwargs["default_max_packet_size"] = profile.max_packet_size
+    transport = ssh.Transport(sock, **kwargs)
+
+    options = transport.get_security_options()
+    for attr, preferred in (("ciphers", profile.ciphers), ("kex", profile.kex),
+                            ("digests", profile.macs)):
+        if preferred:
+            supported = getattr(options, attr)
+            ordered = [x for x in preferred if x in supported]
+            ordered.extend(x for x in supported if x not in preferred)
+            setattr(options, attr, tuple(ordered))
+    if profile.compress:
+        transport.use_compression(True)
+    if profile.rekey_bytes is not None:
+        transport.packetizer.REKEY_BYTES = profile.rekey_bytes
+    if profile.rekey_packets is not None:
+        transport.packetizer.REKEY_PACKETS = profile.rekey_packets
+    return transport
+
+
+def _key_fingerprint(key):
+    return binascii.hexlify(key.get_fingerprint()).decode('ascii')
+
+
+class SSHAuthMemo(object):
+    """Remembers which authentication method and key worked for a host, port and username.
+
+    Connections try the remembered method (and key) first, avoiding round trips, and possibly
+    lockouts, from servers rejecting the other methods and keys. Nothing secret is stored, only the
+    name of the method and the fingerprint of the key.
+
+    Changes are saved in batches, `save_delay` seconds after the first unsaved change, so that
+    learning many hosts doesn't rewrite the file for each one. Unsaved changes are also saved by
+    `save` and when the process exits.
+
+    :param path: If not `None` a file to load from and save to so that the memo persists.
+    :param save_delay: The time in seconds to collect changes before saving them.
+    """
+
+    def __init__(self, path=None, save_delay=5):
+        self.path = path
+        self.save_delay = save_delay
+        self.lock = threading.Lock()
+        # Serializes writing the file, held without `lock` so lookups aren't blocked.
+        self.save_lock = threading.Lock()
+        self.memo = {}
+        self.dirty = False
+        self.save_timer = None
+        if path is not None:
+            if os.path.exists(path):
+                try:
+                    with open(path) as f:
+                        self.memo = json.load(f)
+                except (IOError, OSError, ValueError) as error:
+                    logger.warning("Ignoring unreadable auth memo %s: %s", path, str(error))
+            _exit_memos.add(self)
+
+    @staticmethod
+    def _key(host, port, username):
+        return "{}@{}:{}".format(username, host, port)
+
+    def get(self, host, port, username):
+        """Return (method, fingerprint) that last worked or `None`.
+
+        The method is one of "password", "key" (the key given as the password) or "agent".
+        """
+        with self.lock:
+            value = self.memo.get(self._key(host, port, username))
+        if value is None:
+            return None
+        return value["method"], value["fingerprint"]
+
+    def set(self, host, port, username, method, fingerprint):
+        """Record the method (and key fingerprint) that worked"""
+        with self.lock:
+            self.memo[self._key(host, port, username)] = dict(
+                method=method, fingerprint=fingerprint)
+            if self.path is None:
+                return
+            self.dirty = True
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(self.save_delay, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def save(self):
+        """Save any unsaved changes now."""
+        with self.save_lock:
+            with self.lock:
+                timer = self.save_timer
+                self.save_timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+                memo = dict(self.memo)
+            if timer is not None and timer is not threading.current_thread():
+                timer.cancel()
+            self._save(memo)
+
+    def _save(self, memo):
+        """Must enter with `save_lock` locked"""
+        tmpname = None
+        try:
+            # Unique so that other memos saving the same path don't write the same file.
+            fd, tmpname = tempfile.mkstemp(
+                suffix=".tmp",
+                prefix=os.path.basename(self.path) + ".",
+                dir=os.path.dirname(self.path) or ".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(memo, f)
+            getattr(os, "replace", os.rename)(tmpname, self.path)
+        except (IOError, OSError) as error:
+            logger.warning("Unable to save auth memo %s: %s", self.path, str(error))
+            if tmpname is not None and os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+    def _after_fork(self):
+        """Reset in a child process after a fork, the parent saves the changes it has."""
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.save_timer = None
+
+
+# Memos with a path to save unsaved changes of when exiting.
+_exit_memos = weakref.WeakSet()
+
+
+def _save_exit_memos():
+    for memo in list(_exit_memos):
+        memo.save()
+
+
+atexit.register(_save_exit_memos)
+
+
+class _SharedAgentKey(object):
+    """A key held by the ssh agent of a `SSHAgentCache`.
+
+    Signing requests are made one at a time holding the cache's `request_lock`, so that requests
+    from different transport threads don't interleave on the shared agent connection, and through
+    the cache's current connection if the one the key was listed on has since been replaced.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def __getattr__(self, name):
+        return getattr(self.key, name)
+
+    def sign_ssh_data(self, *args, **kwargs):
+        cache = self.cache
+        with cache.request_lock:
+            agent = cache.agent
+            if self.key.agent is not agent:
+                blob = self.key.asbytes()
+                keys = [] if agent is None else [x for x in agent.get_keys() if x.asbytes() == blob]
+                if not keys:
+                    raise ssh.SSHException("Key no longer held by ssh-agent")
+                self.key = keys[0]
+            return self.key.sign_ssh_data(*args, **kwargs)
+
+
+class SSHAgentCache(object):
+    """A long lived connection to the ssh agent and a cache of the keys it holds.
+
+    The agent is connected to on first use and connected to again, to fetch the key list, after
+    `ttl` seconds. If using the agent fails the connection is closed and a new one made on next
+    use.
+
+    :param ttl: The time in seconds to keep the key list.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Held for each request on the agent connection and when replacing it.
+        self.request_lock = threading.Lock()
+        self.agent = None
+        self.keys = []
+        self.expire = 0
+
+    def _replace(self, agent):
+        """Use the `ssh.Agent` `agent` (or `None`) closing the current one, must enter locked."""
+        with self.request_lock:
+            old = self.agent
+            self.agent = agent
+        self.keys = [] if agent is None else [_SharedAgentKey(self, x) for x in agent.get_keys()]
+        if old is not None:
+            old.close()
+
+    def get_keys(self):
+        """Return a list of the keys held by the agent."""
+        with self.lock:
+            now = _now()
+            if self.agent is None or now >= self.expire:
+                try:
+                    agent = ssh.Agent()
+                except (ssh.SSHException, socket.error) as error:
+                    logger.warning("Unable to use ssh-agent: %s", str(error))
+                    agent = None
+                self._replace(agent)
+                self.expire = now + self.ttl
+            return list(self.keys)
+
+    def failed(self, key):
+        """Note that using `key` from `get_keys` failed other than by the server refusing it."""
+        with self.lock:
+            if self.agent is None or getattr(key, "agent", None) is not self.agent:
+                return
+            logger.debug("Closing failed ssh-agent connection")
+            self._replace(None)
+            self.expire = 0
+
+    def close(self):
+        """Close the connection to the agent."""
+        with self.lock:
+            self._replace(None)
+            self.expire = 0
+
+    def _after_fork(self):
+        """Reset in a child process after a fork, the parent keeps using its agent connection."""
+        self.lock = threading.Lock()
+        self.request_lock = threading.Lock()
+        with self.lock:
+            self._replace(None)
+            self.expire = 0
+
+
+class _TimeoutShard(object):
+    """The keys of a `SSHAdaptiveTimeout` that hash to one shard, guarded by its own lock."""
+
+    __slots__ = ("lock", "keys")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [last released, mean, deviation], least recently released first.
+        self.keys = collections.OrderedDict()
+
+
+class SSHAdaptiveTimeout(object):
+    """An idle timeout for cached sockets that adapts to how soon each key is reused.
+
+    The time between a key's sockets becoming unused and the key being requested again is
+    tracked with moving averages of its mean and deviation (like a TCP retransmit timeout). An
+    unused socket is kept open for the mean plus four deviations, bounded by `min_timeout` and
+    `max_timeout`. If that is over `max_timeout`, or the key has not been reused yet, reuse is
+    unlikely and `min_timeout` is used.
+
+    The keys are spread over `shards` by hash, each with its own lock and least recently
+    released order, so that requests and releases for different hosts rarely contend. Each shard
+    remembers its share of `max_keys`.
+
+    :param min_timeout: The shortest time to keep an unused socket open.
+    :param max_timeout: The longest time to keep an unused socket open.
+    :param gain: The weight given to each new sample in the moving averages.
+    :param max_keys: The number of keys to remember, the least recently released of a shard are
+                     forgotten.
+    :param shards: The number of shards to spread the keys over.
+    """
+
+    def __init__(self, min_timeout=.5, max_timeout=60, gain=.25, max_keys=1000, shards=16):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.gain = gain
+        self.max_keys = max_keys
+        nshards = max(1, min(shards, max_keys))
+        self.shards = [_TimeoutShard() for unused in range(0, nshards)]
+        self.shard_max_keys = -(-max_keys // nshards)
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def requested(self, key, now):
+        """Note that a socket for `key` was requested at `now`."""
+        shard = self._shard(key)
+        with shard.lock:
+            state = shard.keys.get(key)
+            if state is None or state[0] is None:
+                return
+            gap = now - state[0]
+            state[0] = None
+            if state[1] is None:
+                state[1] = gap
+                state[2] = gap / 2
+            else:
+                state[2] += self.gain * (abs(gap - state[1]) - state[2])
+                state[1] += self.gain * (gap - state[1])
+
+    def released(self, key, now):
+        """Note that a socket for `key` became unused at `now`."""
+        shard = self._shard(key)
+        with shard.lock:
+            # Move the key to the most recently released end.
+            state = shard.keys.pop(key, None)
+            if state is None:
+                state = [None, None, None]
+                while len(shard.keys) >= self.shard_max_keys:
+                    shard.keys.popitem(last=False)
+            shard.keys[key] = state
+            state[0] = now
+
+    def timeout(self, key):
+        """Return the time to keep an unused socket for `key` open."""
+        shard = self._shard(key)
+        with shard.lock:
+            state = shard.keys.get(key)
+            if state is None or state[1] is None:
+                return self.min_timeout
+            timeout = state[1] + 4 * state[2]
+        if timeout > self.max_timeout:
+            return self.min_timeout
+        return max(self.min_timeout, timeout)
+
+    def _after_fork(self):
+        """Reset in a child process after a fork."""
+        for shard in self.shards:
+            shard.lock = threading.Lock()
+
+
+class _ExpiryReaper(object):
+    """A single thread that expires idle cache entries at their deadline.
+
+    Deadlines are kept in a heap with each item having at most one live deadline. Replaced and
+    canceled deadlines are left in the heap and skipped when reached, once they outnumber the live
+    ones by more than `slack` the heap is rebuilt so its size stays proportional to the number of
+    idle items. The thread is only woken when a deadline earlier than the one it is waiting for is
+    scheduled. The thread exits after `idle_exit` seconds without any scheduled deadlines and is
+    restarted on demand, it only holds a weak reference to the cache.
+    """
+
+    idle_exit = 60
+    slack = 64
+
+    def __init__(self, cache):
+        self.cache_ref = weakref.ref(cache)
+        self.name = "SSHCacheReaper {}".format(cache.desc)
+        self.heap = []
+        # item -> sequence number of its live deadline in the heap.
+        self.live = {}
+        self.sequence = itertools.count()
+        self.cv = threading.Condition(threading.Lock())
+        self.thread = None
+        # The deadline the thread is waiting for, `None` if it isn't waiting for one.
+        self.wake = None
+
+    def schedule(self, deadline, item):
+        """Schedule `item` to be expired by the cache at `deadline` replacing any earlier
+        deadline."""
+        with self.cv:
+            sequence = next(self.sequence)
+            self.live[item] = sequence
+            heapq.heappush(self.heap, (deadline, sequence, item))
+            self._compact()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.wake is None or deadline < self.wake:
+                # We are the new earliest deadline
+                self.cv.notify()
+
+    def cancel(self, item):
+        """Cancel the deadline of `item` if it has one"""
+        with self.cv:
+            if self.live.pop(item, None) is not None:
+                self._compact()
+
+    def _compact(self):
+        """Drop stale deadlines once they outnumber the live ones, must enter locked."""
+        if len(self.heap) > 2 * len(self.live) + self.slack:
+            live = self.live
+            self.heap = [x for x in self.heap if live.get(x[2]) == x[1]]
+            heapq.heapify(self.heap)
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while True:
+                    if not self.heap:
+                        self.cv.wait(self.idle_exit)
+                        if not self.heap:
+                            self.thread = None
+                            return
+                        continue
+                    deadline, sequence, item = self.heap[0]
+                    if self.live.get(item) != sequence:
+                        heapq.heappop(self.heap)
+                        continue
+                    delta = deadline - _now()
+                    if delta <= 0:
+                        heapq.heappop(self.heap)
+                        del self.live[item]
+                        break
+                    self.wake = deadline
+                    self.cv.wait(delta)
+                    self.wake = None
+
+            cache = self.cache_ref()
+            if cache is None:
+                with self.cv:
+                    self.thread = None
+                return
+            try:
+                cache._close_socket_expire(item, deadline)  # pylint: disable=W0212
+            except Exception as error:  # pylint: disable=W0703
+                logger.error("%s: Unexpected error expiring socket: %s: %s", self.name,
+                             str(error), traceback.format_exc())
+            del cache
+
+
+class _LivenessMonitor(object):
+    """A single thread that watches cached connections for remote closure.
+
+    Every `interval` seconds the transports are checked for having gone inactive, and the OS
+    sockets, which are registered in one selector for as long as they are cached, are checked for
+    EOF. Entries found closed are reported to the cache. This keeps these checks and their system
+    calls off of the cache lookup path. As the transport threads read the sockets too, the
+    selector is polled at most once per interval so normal traffic doesn't keep us spinning. The
+    thread exits after `idle_exit` seconds without any entries and is restarted on demand, it only
+    holds a weak reference to the cache.
+    """
+
+    idle_exit = 60
+
+    def __init__(self, cache, interval):
+        self.cache_ref = weakref.ref(cache)
+        self.name = "SSHCacheMonitor {}".format(cache.desc)
+        self.interval = interval
+        self.selector = selectors.DefaultSelector()
+        self.entries = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, entry):
+        """Start watching `entry`"""
+        with self.lock:
+            self.entries.add(entry)
+            try:
+                if not isinstance(entry.ossock, socket.socket):
+                    raise TypeError("not a socket")
+                self.selector.register(entry.ossock, selectors.EVENT_READ, entry)
+            except (AttributeError, KeyError, TypeError, ValueError) as error:
+                # e.g., ProxyCommand or a jump host channel, we'll notice when the transport does.
+                logger.debug("%s: Not selecting on %s: %s", self.name, str(entry.ossock),
+                             str(error))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unregister(self, entry):
+        """Stop watching `entry`, must be called prior to closing its OS socket."""
+        with self.lock:
+            self.entries.discard(entry)
+            try:
+                self.selector.unregister(entry.ossock)
+            except (KeyError, ValueError):
+                pass
+
+    def _run(self):
+        idle = 0
+        while True:
+            with self.lock:
+                if not self.entries:
+                    if idle >= self.idle_exit:
+                        self.thread = None
+                        return
+                    idle += self.interval
+                else:
+                    idle = 0
+
+            start = _now()
+            try:
+                events = self.selector.select(self.interval)
+            except (OSError, ValueError) as error:
+                # A socket was closed under us, try again next time.
+                logger.debug("%s: select error: %s", self.name, str(error))
+                events = []
+
+            dead = set(key.data for key, unused in events if _socket_is_remote_closed(key.fileobj))
+            with self.lock:
+                dead.update(entry for entry in self.entries if not entry.sshsock.is_active())
+            if dead:
+                cache = self.cache_ref()
+                if cache is None:
+                    with self.lock:
+                        self.thread = None
+                    return
+                for entry in dead:
+                    self.unregister(entry)
+                    cache._socket_dead(entry)  # pylint: disable=W0212
+                del cache
+
+            # Don't spin on sockets with data waiting for their transport to read it.
+            remaining = self.interval - (_now() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+class _CacheEntry(object):
+    """A cached ssh socket and the number of channels using it.
+
+    The idle deadline is only stamped on the entry when it is used and released, the reaper's
+    deadline for it is left in place while `scheduled` and the reaper catches up with the entry
+    when that is reached. This keeps the reaper's lock off of the lookup and release paths.
+    """
+
+    __slots__ = ("key", "shard", "ossock", "sshsock", "count", "expire", "idle_since", "scheduled",
+                 "dead")
+
+    def __init__(self, key, shard, ossock, sshsock):
+        self.key = key
+        self.shard = shard
+        self.ossock = ossock
+        self.sshsock = sshsock
+        self.count = 1
+        # The deadline for closing when idle, otherwise None.
+        self.expire = None
+        # When the entry last became unused.
+        self.idle_since = None
+        # The deadline the reaper has for the entry, if set no later than `expire`, otherwise
+        # None.
+        self.scheduled = None
+        # Set by the liveness monitor when the remote side has closed the socket.
+        self.dead = False
+
+
+class _PendingConnect(object):
+    """A connection being established for a cache key that other requesters can wait on.
+
+    :param spare: True if this is a spare opened in the background, its error isn't given to the
+                  requesters waiting on it.
+    """
+
+    def __init__(self, spare=False):
+        self.event = threading.Event()
+        self.error = None
+        self.spare = spare
+
+
+class _KeyShard(object):
+    """The cache state for one set of connection arguments, guarded by its own lock.
+
+    A shard is removed from the cache once it has no sockets, no pending connect and no requester
+    waiting for room, a requester that finds it `removed` after locking it must look the key up
+    again.
+    """
+
+    __slots__ = ("key", "lock", "cv", "entries", "idle", "pending", "hits", "waits", "room_waiters",
+                 "removed")
+
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        # sshsock -> entry
+        self.entries = {}
+        # Unused entries waiting to expire, least recently used first.
+        self.idle = collections.OrderedDict()
+        self.pending = None
+        # Counted here to keep hits off of the cache lock, see `_CacheStats.snapshot`.
+        self.hits = 0
+        self.waits = 0
+        # The requesters for this key waiting for room within the cache's `max_sockets`.
+        self.room_waiters = 0
+        self.removed = False
+
+
+class SSHConfigCache(object):
+    """A cache of a parsed ssh config file and of the per-host settings looked up in it.
+
+    The file is reparsed, and the lookups forgotten, when its modification time or size changes.
+    The file is checked at most once every `check_interval` seconds.
+
+    :param path: The path of the ssh config file, "~" is expanded.
+    :param check_interval: The minimum time in seconds between checks of the file for changes.
+    """
+
+    def __init__(self, path="~/.ssh/config", check_interval=1):
+        self.path = os.path.expanduser(path)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.config = None
+        self.stamp = None
+        self.next_check = 0
+        self.lookups = {}
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _check(self):
+        """Must enter locked"""
+        now = _now()
+        if self.config is not None and now < self.next_check:
+            return
+        self.next_check = now + self.check_interval
+        stamp = self._stamp()
+        if self.config is not None and stamp == self.stamp:
+            return
+
+        config = ssh.config.SSHConfig()
+        if stamp is not None:
+            logger.debug("Loading ssh config %s", self.path)
+            try:
+                with open(self.path) as f:
+                    config.parse(f)
+            except (IOError, OSError) as error:
+                logger.warning("Unable to read ssh config %s: %s", self.path, str(error))
+        self.config = config
+        self.stamp = stamp
+        self.lookups = {}
+
+    def lookup(self, host):
+        """Return the settings for `host` as a dictionary (see `paramiko.SSHConfig.lookup`).
+
+        The returned dictionary is shared and must not be modified.
+        """
+        with self.lock:
+            self._check()
+            try:
+                return self.lookups[host]
+            except KeyError:
+                config = self.config.lookup(host)
+                self.lookups[host] = config
+                return config
+
+    def _after_fork(self):
+        """Reset in a child process after a fork."""
+        self.lock = threading.Lock()
+
+
+def _interleave_families(addrinfos):
+    """Order addresses alternating address families starting with the first (RFC 8305 4.)"""
+    families = collections.OrderedDict()
+    for addrinfo in addrinfos:
+        families.setdefault(addrinfo[0], []).append(addrinfo)
+    ordered = []
+    queues = list(families.values())
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+def _connect_happy_eyeballs(addrinfos, delay=.25, timeout=None):
+    """Connect to the first address to answer (RFC 8305 "Happy Eyeballs").
+
+    Connection attempts are started in order, each `delay` seconds after the previous one or as
+    soon as the previous one fails, so a dead address doesn't hold up the others.
+
+    :param addrinfos: The `socket.getaddrinfo` results to connect to.
+    :param delay: The time to wait for an attempt before also starting the next.
+    :param timeout: The time allowed for connecting or `None` for no limit.
+    :return: (socket, addrinfo) of the connected socket.
+    :raises: socket.error from the last failed attempt or socket.timeout.
+    """
+    expire = None if timeout is None else _now() + timeout
+    selector = selectors.DefaultSelector()
+    pending = {}
+    remaining = list(addrinfos)
+    error = None
+    try:
+        while remaining or pending:
+            if remaining:
+                addrinfo = remaining.pop(0)
+                af, socktype, proto, unused_name, sa = addrinfo
+                sock = None
+                try:
+                    sock = socket.socket(af, socktype, proto)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sa)
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        raise socket.error(err, os.strerror(err))
+                except socket.error as ex:
+                    logger.debug("Got socket error connecting to: %s: %s", str(addrinfo), str(ex))
+                    error = ex
+                    if sock is not None:
+                        sock.close()
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE, addrinfo)
+                pending[sock] = addrinfo
+
+            # Wait for an attempt to complete, or the delay to start the next.
+            wait = delay if remaining else None
+            if expire is not None:
+                left = expire - _now()
+                if left <= 0:
+                    raise socket.timeout("Timed out connecting")
+                wait = left if wait is None else min(wait, left)
+            for key, unused in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                addrinfo = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    error = socket.error(err, os.strerror(err))
+                    logger.debug("Got socket error connecting to: %s: %s", str(addrinfo),
+                                 str(error))
+                    sock.close()
+                    continue
+                sock.setblocking(True)
+                return sock, addrinfo
+        if error is None:
+            error = socket.error("No addresses to connect to")
+        raise error
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+
+class SSHResolverCache(object):
+    """A cache of host name resolutions that also remembers which address connected.
+
+    Addresses are ordered alternating address families for connecting with
+    `_connect_happy_eyeballs`, except that the address that last connected is tried first.
+
+    :param ttl: The time in seconds to keep a resolution.
+    :param max_winners: The number of hosts to remember the address that connected for, the least
+                        recently connected are forgotten first.
+    """
+
+    def __init__(self, ttl=60, max_winners=1000):
+        self.ttl = ttl
+        self.max_winners = max_winners
+        self.lock = threading.Lock()
+        # (host, port) -> (expire, addrinfos)
+        self.resolved = {}
+        # (host, port) -> sockaddr that last connected, least recently connected first.
+        self.winners = collections.OrderedDict()
+
+    def _order(self, key, addrinfos):
+        winner = self.winners.get(key)
+        if winner is not None:
+            addrinfos.sort(key=lambda addrinfo: addrinfo[4] != winner)
+        return addrinfos
+
+    def resolve(self, host, port):
+        """Return a list of `socket.getaddrinfo` results for `host` and `port` to connect to."""
+        key = (host, port)
+        with self.lock:
+            resolved = self.resolved.get(key)
+            if resolved is not None and resolved[0] > _now():
+                return list(resolved[1])
+
+        addrinfos = _interleave_families(
+            socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM))
+        with self.lock:
+            addrinfos = self._order(key, addrinfos)
+            # Forget anything that has expired so we don't grow without bound.
+            now = _now()
+            if len(self.resolved) > 1000:
+                for okey in [k for k, v in self.resolved.items() if v[0] <= now]:
+                    del self.resolved[okey]
+            self.resolved[key] = (now + self.ttl, addrinfos)
+            return list(addrinfos)
+
+    def connected(self, host, port, addrinfo):
+        """Remember that `addrinfo` connected for `host` and `port`."""
+        key = (host, port)
+        with self.lock:
+            winner = self.winners.pop(key, None)
+            self.winners[key] = addrinfo[4]
+            if winner == addrinfo[4]:
+                return
+            if len(self.winners) > self.max_winners:
+                self.winners.popitem(last=False)
+            resolved = self.resolved.get(key)
+            if resolved is not None:
+                self.resolved[key] = (resolved[0], self._order(key, list(resolved[1])))
+
+    def _after_fork(self):
+        """Reset in a child process after a fork."""
+        self.lock = threading.Lock()
+
+
+class SSHJumpHost(object):
+    """A bastion host to reach other hosts through (like ssh -J or ProxyJump).
+
+    Pass this as the `proxycmd` argument to connect through the bastion. The bastion's transport
+    is cached like any other and each host behind it is reached over a "direct-tcpip" channel on
+    it, so many hosts share one (or a few) bastion connections. Each host reached uses one of the
+    bastion transport's channels (see `max_channels`).
+
+    :param host: The bastion hostname.
+    :param port: The bastion ssh port.
+    :param username: The username for the bastion if `None` getpass.get_user() is used.
+    :param password: The password or public key for the bastion, see `SSHConnection`.
+    :param proxycmd: A proxy command or `SSHJumpHost` to reach the bastion through.
+    """
+
+    def __init__(self, host, port=22, username=None, password=None, proxycmd=None):
+        self.host = host
+        self.port = int(port)
+        self.username = username if username else getpass.getuser()
+        self.password = password
+        self.proxycmd = proxycmd
+
+    @classmethod
+    def parse(cls, spec):
+        """Return a `SSHJumpHost` for a ProxyJump style "[user@]host[:port][,...]" `spec`."""
+        jumphost = None
+        for hop in spec.split(","):
+            username, unused, hostport = hop.strip().rpartition("@")
+            if hostport.startswith("["):
+                host, unused, port = hostport[1:].partition("]")
+                port = port.lstrip(":")
+            elif hostport.count(":") == 1:
+                host, port = hostport.split(":")
+            else:
+                host, port = hostport, None
+            jumphost = cls(host, int(port) if port else 22, username or None, None, jumphost)
+        return jumphost
+
+    def _key(self):
+        return (self.host, self.port, self.username, self.password, self.proxycmd)
+
+    def __eq__(self, other):
+        return isinstance(other, SSHJumpHost) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        hop = "{}@{}:{}".format(self.username, self.host, self.port)
+        if isinstance(self.proxycmd, SSHJumpHost):
+            return "{},{}".format(self.proxycmd, hop)
+        return hop
+
+    def __repr__(self):
+        return "SSHJumpHost({})".format(self)
+
+
 class _SSHConnectionCache(object):
     ssh_config = None
+    resolver = SSHResolverCache()
+    auth_memo = None
+    ssh_agent = None
+
+    # The time to wait for a connect to an address before also trying the next.
+    connect_delay = .25
+
+    def __init__(self):
+        # The process the cache's sockets belong to.
+        self.pid = os.getpid()
 
     @classmethod
     def init_class_config(cls):
+        """Initialize the ssh config shared by caches not given their own."""
         # XXX do we want to initialize this elsewhere?
         if cls.ssh_config is None:
-            cls.ssh_config = ssh.config.SSHConfig()
-            configname = os.path.expanduser("~/.ssh/config")
-            if os.path.exists(configname):
-                with open(configname) as f:
-                    cls.ssh_config.parse(f)
+            cls.ssh_config = SSHConfigCache()
 
     @classmethod
-    def open_os_socket(cls, host, port, use_config=True, debug=False, proxycmd=None):
+    def open_os_socket(cls,
+                       host,
+                       port,
+                       use_config=True,
+                       debug=False,
+                       proxycmd=None,
+                       ssh_config=None,
+                       resolver=None,
+                       timeout=None):
         if use_config:
-            cls.init_class_config()
-            config = cls.ssh_config.lookup(host)
+            if ssh_config is None:
+                cls.init_class_config()
+                ssh_config = cls.ssh_config
+            config = ssh_config.lookup(host)
 
             # If we have a proxy command use that.
             if proxycmd or 'proxycommand' in config:
@@ -84,15 +1275,11 @@ class _SSHConnectionCache(object):
                 logger.debug("Using proxy command for host %s port %s: %s", host, str(port), proxy)
                 return ssh.ProxyCommand(proxy)
 
-            if 'port' in config:
-                newport = config['port']
-            else:
-                newport = port
-
-            if 'host' in config:
-                host = config['host']
+            if 'hostname' in config:
+                host = config['hostname']
 
             if 'port' in config:
+                newport = int(config['port'])
                 if port != 22 and port != newport:
                     # XXX should we just never do this?
                     logger.warning("Remaping non-std ssh port %d using config to port %d", port,
@@ -103,48 +1290,121 @@ class _SSHConnectionCache(object):
         if debug:
             logger.debug("Opening os socket to %s on port %s", str(host), str(port))
 
-        attempt = 0
+        if resolver is None:
+            resolver = cls.resolver
         try:
-            error = None
-            for addrinfo in socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM):
-                af, socktype, proto, unused_name, sa = addrinfo
-                try:
-                    ossock = socket.socket(af, socktype, proto)
-                    ossock.connect(sa)
-                    if attempt:
-                        logger.debug("Succeeded after %s attempts to : %s", str(attempt),
-                                     str(addrinfo))
-                    return ossock
-                except socket.error as ex:
-                    logger.debug("Got socket error connecting to: %s: %s", str(addrinfo), str(ex))
-                    attempt += 1
-                    error = ex
-                    continue
-            if error is not None:
-                logger.debug(
-                    "Got error connecting to: %s: %s (no addr)",
-                    str(addrinfo),  # pylint: disable=W0631
-                    str(error))
-                raise error  # pylint: disable=E0702
-            raise Exception("Couldn't connect to any resolution for {}:{}".format(host, port))
+            addrinfos = resolver.resolve(host, port)
+            ossock, addrinfo = _connect_happy_eyeballs(addrinfos, cls.connect_delay, timeout)
+            resolver.connected(host, port, addrinfo)
+            if debug:
+                logger.debug("Connected to: %s", str(addrinfo))
+            return ossock
         except Exception as ex:
             logger.error("Got unexpected socket error connecting to: %s:%s: %s", str(host),
                          str(port), str(ex))
             raise
 
-    @classmethod
-    def _open_ssh_socket(cls, host, port, username, password, use_config, debug, proxy):
-        ossock = cls.open_os_socket(host, port, use_config, debug, proxy)
+    def _config_jump_host(self, host, port):
+        """Return the `SSHJumpHost`, host and port to use from a ProxyJump in the ssh config."""
+        ssh_config = self.ssh_config
+        if ssh_config is None:
+            _SSHConnectionCache.init_class_config()
+            ssh_config = _SSHConnectionCache.ssh_config
+        config = ssh_config.lookup(host)
+        spec = config.get("proxyjump")
+        if not spec or spec.lower() == "none" or "proxycommand" in config:
+            return None, host, port
+        jumphost = SSHJumpHost.parse(spec)
+        if jumphost.host == host:
+            return None, host, port
+        return jumphost, config.get("hostname", host), int(config.get("port", port))
+
+    def _open_jump_channel(self, jumphost, host, port, debug, deadline, profile):
+        """Open a "direct-tcpip" channel to `host` and `port` on a cached `jumphost` transport.
+
+        The returned channel holds a reference on the bastion transport which is released by
+        `_close_os_socket`.
+        """
+        while True:
+            bastion = self.get_ssh_socket(jumphost.host, jumphost.port, jumphost.username,
+                                          jumphost.password, debug, jumphost.proxycmd, deadline,
+                                          profile)
+            start = _now()
+            try:
+                if debug:
+                    logger.debug("Opening direct-tcpip channel to %s:%s through %s", str(host),
+                                 str(port), str(jumphost))
+                chan = bastion.open_channel(
+                    "direct-tcpip", (host, port), ("127.0.0.1", 0),
+                    timeout=deadline.remaining("connect"))
+            except ssh.ChannelException as error:
+                if not self.channel_open_failed(bastion, debug):
+                    raise
+                logger.debug("Channel refused by %s, retrying: %s", str(jumphost), str(error))
+                continue
+            except Exception:
+                self.release_ssh_socket(bastion, debug)
+                deadline.remaining("connect", start)
+                raise
+            chan.bastion = bastion
+            return chan
+
+    def _close_os_socket(self, ossock, debug):
+        """Close an OS socket (or jump host channel) must not be called locked."""
+        bastion = getattr(ossock, "bastion", None)
+        ossock.close()
+        if bastion is not None:
+            ossock.bastion = None
+            self.release_ssh_socket(bastion, debug)
+
+    def _open_ssh_socket(self,
+                         host,
+                         port,
+                         username,
+                         password,
+                         use_config,
+                         debug,
+                         proxy,
+                         deadline=None,
+                         profile=None):
+        auth_memo = self.auth_memo
+        # The auth memo is keyed on the host asked for, not where a ProxyJump takes us.
+        memo_host, memo_port = host, port
+        if deadline is None:
+            deadline = SSHDeadline()
+        jumphost = None
+        if isinstance(proxy, SSHJumpHost):
+            jumphost = proxy
+        elif proxy is None and use_config:
+            jumphost, host, port = self._config_jump_host(host, port)
+        try:
+            if jumphost is not None:
+                ossock = self._open_jump_channel(jumphost, host, port, debug, deadline, profile)
+            else:
+                ossock = self.open_os_socket(host, port, use_config, debug, proxy,
+                                             self.ssh_config, self.resolver,
+                                             deadline.remaining("connect"))
+        except SSHTimeoutError:
+            raise
+        except socket.timeout:
+            raise deadline.timed_out("connect")
+
+        sshsock = None
         try:
             if debug:
                 logger.debug("Opening SSH socket to %s:%s", str(host), str(port))
 
-            sshsock = ssh.Transport(ossock)
+            sshsock = _new_transport(ossock, profile)
             # self.ssh.set_missing_host_key_policy(ssh.AutoAddPolicy())
 
-            # XXX this takes an event so we could yield here to wait for event.
+            started = threading.Event()
+            sshsock.start_client(started)
+            if not started.wait(deadline.remaining("handshake")):
+                raise deadline.timed_out("handshake")
+            if not sshsock.is_active():
+                error = sshsock.get_exception()
+                raise error if error is not None else ssh.SSHException("Negotiation failed.")
             event = None
-            sshsock.start_client(event)
 
             # XXX save this if we actually need it.
             sshsock.get_remote_server_key()
@@ -164,50 +1424,84 @@ class _SSHConnectionCache(object):
             #     pass
 
             logger.debug("Trying to authenticate with username: %s", str(username))
-            autherr = ("No authentication methods worked")
-            if not sshsock.is_authenticated() and password is not None:
-                try:
-                    sshsock.auth_password(username, password, event, False)
-                except ssh.BadAuthenticationType as error:
-                    logger.debug("Password auth not allowed (cont): %s: %s", str(username),
-                                 str(error))
-                    autherr = error
-                except ssh.AuthenticationException as error:
-                    logger.debug("Password auth failed (cont): %s: %s", str(username), str(error))
-                    autherr = error
-                else:
-                    if not sshsock.is_authenticated():
-                        logger.warning("Password auth failed no error (cont) for %s", str(username))
-
-            if not sshsock.is_authenticated() and passkey is not None:
-                try:
-                    sshsock.auth_publickey(username, passkey, event)
-                except ssh.AuthenticationException as error:
-                    logger.debug("Pubkey auth failed (cont): %s", str(error))
-                    autherr = error
-                else:
-                    if not sshsock.is_authenticated():
-                        logger.warning("Pubkey auth failed no error (cont)")
-
-            if not sshsock.is_authenticated():
-                ssh_keys = ssh.Agent().get_keys()
-                if _private_key:
-                    # Used by travis-ci
-                    ssh_keys += (_private_key, )
-                lastkey = len(ssh_keys) - 1
-                for idx, ssh_key in enumerate(ssh_keys):
-                    if sshsock.is_authenticated():
-                        break
+            autherr = ssh.AuthenticationException("No authentication methods worked")
+
+            # Try the method that worked last time first.
+            known = auth_memo.get(memo_host, memo_port, username) if auth_memo is not None else None
+            methods = ["password", "key", "agent"]
+            if known is not None and known[0] in methods:
+                methods.remove(known[0])
+                methods.insert(0, known[0])
+
+            authed = None
+            auth_start = _now()
+            for method in methods:
+                if sshsock.is_authenticated():
+                    break
+                timeout = deadline.remaining("auth", auth_start)
+                if timeout is not None:
+                    sshsock.auth_timeout = timeout
+                if method == "password" and password is not None:
                     try:
-                        sshsock.auth_publickey(username, ssh_key, event)
+                        sshsock.auth_password(username, password, event, False)
+                    except ssh.BadAuthenticationType as error:
+                        logger.debug("Password auth not allowed (cont): %s: %s", str(username),
+                                     str(error))
+                        autherr = error
+                    except ssh.AuthenticationException as error:
+                        logger.debug("Password auth failed (cont): %s: %s", str(username),
+                                     str(error))
+                        autherr = error
+                    else:
+                        if not sshsock.is_authenticated():
+                            logger.warning("Password auth failed no error (cont) for %s",
+                                           str(username))
+                        else:
+                            authed = (method, None)
+                elif method == "key" and passkey is not None:
+                    try:
+                        sshsock.auth_publickey(username, passkey, event)
                     except ssh.AuthenticationException as error:
-                        if idx == lastkey:
-                            raise
                         logger.debug("Pubkey auth failed (cont): %s", str(error))
-                        # Try next key
+                        autherr = error
+                    else:
+                        if not sshsock.is_authenticated():
+                            logger.warning("Pubkey auth failed no error (cont)")
+                        else:
+                            authed = (method, _key_fingerprint(passkey))
+                elif method == "agent":
+                    ssh_keys = self.ssh_agent.get_keys()
+                    if _private_key:
+                        # Used by travis-ci
+                        ssh_keys.append(_private_key)
+                    if known is not None and known[0] == method:
+                        # Stable sort the known good key to the front.
+                        ssh_keys.sort(key=lambda k: _key_fingerprint(k) != known[1])
+                    for ssh_key in ssh_keys:
+                        timeout = deadline.remaining("auth", auth_start)
+                        if timeout is not None:
+                            sshsock.auth_timeout = timeout
+                        try:
+                            sshsock.auth_publickey(username, ssh_key, event)
+                        except ssh.AuthenticationException as error:
+                            logger.debug("Pubkey auth failed (cont): %s", str(error))
+                            autherr = error
+                            # Try next key
+                        except ssh.SSHException:
+                            self.ssh_agent.failed(ssh_key)
+                            raise
+                        else:
+                            if sshsock.is_authenticated():
+                                authed = (method, _key_fingerprint(ssh_key))
+                                break
             if not sshsock.is_authenticated():
+                # An auth method failing by timing out means the deadline has passed.
+                deadline.remaining("auth", auth_start)
                 raise autherr
 
+            if authed is not None and auth_memo is not None and authed != known:
+                auth_memo.set(memo_host, memo_port, username, *authed)
+
             # nextauth (rval from above) would be a secondary authentication e.g., google authenticator.
 
             # XXX using the below instead of the breakout above fails threaded.
@@ -216,39 +1510,157 @@ class _SSHConnectionCache(object):
             #                 password=self.password)
             return ossock, sshsock
         except ssh.BadAuthenticationType as error:
-            ossock.close()
+            self._close_failed(ossock, sshsock, debug)
             logger.error("Authentication not allowed: %s", str(error))
             raise
         except ssh.AuthenticationException as error:
-            ossock.close()
+            self._close_failed(ossock, sshsock, debug)
             logger.error("Authentication failed: %s", str(error))
             raise
+        except SSHTimeoutError as error:
+            self._close_failed(ossock, sshsock, debug)
+            logger.error("Opening SSH socket to %s:%s: %s", str(host), str(port), str(error))
+            raise
+        except Exception:
+            self._close_failed(ossock, sshsock, debug)
+            raise
+
+    def _close_failed(self, ossock, sshsock, debug):
+        if sshsock is not None:
+            sshsock.close()
+        self._close_os_socket(ossock, debug)
+
+    def _after_fork(self):
+        """Reset in a child process after a fork."""
+        self.pid = os.getpid()
+        self.auth_memo._after_fork()  # pylint: disable=W0212
+        self.ssh_agent._after_fork()  # pylint: disable=W0212
+        if "ssh_config" in self.__dict__:
+            self.ssh_config._after_fork()  # pylint: disable=W0212
 
     def release_ssh_socket(self, ssh_socket, debug):
         raise NotImplementedError("release_ssh_socket")
 
-    def get_ssh_socket(self, host, port, username, password, debug, proxycmd=None):
+    def channel_open_failed(self, ssh_socket, debug):
+        """Release a socket on which the server refused to open another channel.
+
+        :return: True if the caller should retry with a new socket from `get_ssh_socket`.
+        """
+        self.release_ssh_socket(ssh_socket, debug)
+        return False
+
+    def channel_limit(self, host, port):
+        """Return the number of channels opened on one socket to a host.
+
+        :return: The limit or `None` if each channel has a socket of its own.
+        """
+        del host, port  # unused
+        return None
+
+    def get_ssh_socket(self,
+                       host,
+                       port,
+                       username,
+                       password,
+                       debug,
+                       proxycmd=None,
+                       deadline=None,
+                       profile=None):
         raise NotImplementedError("get_ssh_socket")
 
 
 class SSHNoConnectionCache(_SSHConnectionCache):
-    "Simple non-caching cache class"
+    """Simple non-caching cache class
+
+    :param auth_memo: A `SSHAuthMemo` to remember working authentication methods in, if `None`
+                      one local to this object is used.
+    :param ssh_config_path: The ssh config file to use, if `None` "~/.ssh/config" shared with
+                            other caches is used.
+    :param ssh_agent: A `SSHAgentCache` to get agent keys from, if `None` one local to this object
+                      is used.
+    """
 
-    def __init__(self, desc=""):
+    def __init__(self, desc="", auth_memo=None, ssh_config_path=None, ssh_agent=None):
+        super(SSHNoConnectionCache, self).__init__()
         self.desc = desc
+        self.auth_memo = auth_memo if auth_memo is not None else SSHAuthMemo()
+        self.ssh_agent = ssh_agent if ssh_agent is not None else SSHAgentCache()
+        if ssh_config_path is not None:
+            self.ssh_config = SSHConfigCache(ssh_config_path)
+        self.counters = _CacheStats()
+        self.open_count = 0
+        # The sockets returned and not yet released.
+        self.sockets = weakref.WeakSet()
+        self.lock = threading.Lock()
+        _fork_caches.add(self)
+
+    def _after_fork(self):
+        """Reset in a child process after a fork.
+
+        The sockets already returned are left to the parent. Their transports are made inactive,
+        so that nothing is sent on the parent's connections, and releasing one in the child drops
+        it without closing it.
+        """
+        super(SSHNoConnectionCache, self)._after_fork()
+        for sshsock in list(self.sockets):
+            sshsock.active = False
+        self.counters = _CacheStats()
+        self.open_count = 0
+        self.sockets = weakref.WeakSet()
+        self.lock = threading.Lock()
 
     def release_ssh_socket(self, ssh_socket, debug=False):
+        if _check_fork_pid and self.pid != os.getpid():
+            _after_fork_in_child()
+        with self.lock:
+            if ssh_socket not in self.sockets:
+                # A socket from before a fork, the parent owns its transport so just drop it.
+                if debug:
+                    logger.debug("Dropping untracked ssh socket: %s", str(ssh_socket))
+                return
+            self.sockets.discard(ssh_socket)
+            self.open_count -= 1
         ossock = ssh_socket.os_socket
         ssh_socket.close()
-        ossock.close()
-
-    def get_ssh_socket(self, host, port, username, password, debug, proxycmd=None):
-        # True below is to use users ssh config, should this be part of get_ssh_socket API?
-        ossock, sshsock = _SSHConnectionCache._open_ssh_socket(host, port, username, password, True,
-                                                               debug, proxycmd)
+        self._close_os_socket(ossock, debug)
+
+    def get_ssh_socket(self,
+                       host,
+                       port,
+                       username,
+                       password,
+                       debug,
+                       proxycmd=None,
+                       deadline=None,
+                       profile=None):
+        if _check_fork_pid and self.pid != os.getpid():
+            _after_fork_in_child()
+        start = _now()
+        try:
+            # True below is to use users ssh config, should this be part of get_ssh_socket API?
+            ossock, sshsock = self._open_ssh_socket(host, port, username, password, True, debug,
+                                                    proxycmd, deadline,
+                                                    _transport_profile(profile))
+        except Exception:
+            with self.lock:
+                self.counters.misses += 1
+                self.counters.connect_errors += 1
+            raise
+        with self.lock:
+            self.counters.misses += 1
+            self.counters.handshake.observe(_now() - start)
+            self.open_count += 1
+            self.sockets.add(sshsock)
         sshsock.os_socket = ossock
         return sshsock
 
+    def stats(self):
+        """Return a snapshot of the cache statistics, see `SSHConnectionCache.stats`."""
+        with self.lock:
+            stats = self.counters.snapshot()
+            stats.update(sockets=self.open_count, channels=self.open_count, keys=[])
+        return stats
+
     def flush(self, debug=False):  # pylint: disable=W0613
         return
 
@@ -259,26 +1671,217 @@ class SSHConnectionCache(_SSHConnectionCache):
     Authenticated connections to a given host are cached for a specified amount of time before being
     closed. This allows for connection reuse as well as avoiding re-authentication.
 
+    New channels are placed on the least loaded socket for the host. If a server refuses to open a
+    channel the cache remembers the lower limit for that host and port.
+
+    The number of open sockets may be limited overall and per set of connection arguments. When a
+    limit is reached the least recently used unused socket is closed to make room, if every socket
+    is in use the caller waits until one is released.
+
+    The sockets for each set of connection arguments are kept in a shard with its own lock, so
+    requests and releases for different hosts don't contend with each other.
+
+    The liveness of cached sockets is checked in the background so that looking up a cached socket
+    doesn't require any system calls.
+
+    Hot hosts can be given spare sockets so that bursts of channels don't wait on key exchange.
+    When the channels in use on the sockets for a set of connection arguments reach
+    `spare_threshold` of their capacity, unused spare sockets are opened in the background until
+    there are `min_spares`. Spares are only used once the other sockets are full, and are kept
+    from expiring while the other sockets are in use.
+
     :param close_timeout: Amount of time to wait before closing an opened unused ssh socket.
+    :param close_policy: If not `None` a `SSHAdaptiveTimeout` giving the time to wait before
+                         closing an unused ssh socket instead of `close_timeout`.
     :param max_channels: Maximum number of channels to open on a given ssh socket.
+    :param max_sockets: Maximum number of open ssh sockets or `None` for no limit.
+    :param max_key_sockets: Maximum number of open ssh sockets with the same host, port, username
+                            and proxy command or `None` for no limit.
+    :param monitor_interval: How often in seconds to check cached sockets for remote closure.
+    :param keepalive: If not `None` send SSH keepalives on cached sockets after this many seconds
+                      without traffic, this detects peers that have gone away without closing.
+    :param auth_memo: A `SSHAuthMemo` to remember working authentication methods in, if `None`
+                      one local to the cache is used.
+    :param ssh_config_path: The ssh config file to use, if `None` "~/.ssh/config" shared with
+                            other caches is used.
+    :param ssh_agent: A `SSHAgentCache` to get agent keys from, if `None` one local to the cache
+                      is used.
+    :param min_spares: The number of unused spare sockets to keep for each host, port, username
+                       and proxy command in use.
+    :param host_min_spares: A dictionary overriding `min_spares` by host or by (host, port).
+    :param spare_threshold: The fraction of the channels in use that makes a host need spares.
     """
 
-    def __init__(self, desc="", close_timeout=1, max_channels=8):
+    def __init__(self,
+                 desc="",
+                 close_timeout=1,
+                 max_channels=8,
+                 max_sockets=None,
+                 max_key_sockets=None,
+                 monitor_interval=1,
+                 keepalive=None,
+                 auth_memo=None,
+                 ssh_config_path=None,
+                 ssh_agent=None,
+                 min_spares=0,
+                 host_min_spares=None,
+                 spare_threshold=.75,
+                 close_policy=None):
+        super(SSHConnectionCache, self).__init__()
         self.close_timeout = close_timeout
+        self.close_policy = close_policy
         self.max_channels = max_channels
+        self.max_sockets = max_sockets
+        self.max_key_sockets = max_key_sockets
+        self.min_spares = min_spares
+        self.host_min_spares = host_min_spares or {}
+        self.spare_threshold = spare_threshold
+        self.keepalive = keepalive
+        self.auth_memo = auth_memo if auth_memo is not None else SSHAuthMemo()
+        self.ssh_agent = ssh_agent if ssh_agent is not None else SSHAgentCache()
+        if ssh_config_path is not None:
+            self.ssh_config = SSHConfigCache(ssh_config_path)
         self.desc = desc
-        self.ssh_sockets = {}
-        self.ssh_socket_keys = {}
-        self.ssh_socket_timeout = {}
+        # key -> shard, shards are only added and removed holding `ssh_sockets_lock`.
+        self.shards = {}
+        # sshsock -> entry, an index of the entries in all the shards.
+        self.ssh_socket_entries = {}
+        # The number of connects in progress, counted against `max_sockets`.
+        self.pending_count = 0
+        # (host, port) -> channel limit learned from the server refusing channels.
+        self.host_max_channels = {}
         self.ssh_sockets_lock = threading.Lock()
+        # Notified, when there are `room_waiters`, as room within `max_sockets` may have been
+        # made. `room_changes` counts these events so waiters don't miss one while unlocked.
+        self.room_cv = threading.Condition(self.ssh_sockets_lock)
+        self.room_waiters = 0
+        self.room_changes = 0
+        self.counters = _CacheStats()
+        self.reaper = _ExpiryReaper(self)
+        self.monitor = _LivenessMonitor(self, monitor_interval)
+        _fork_caches.add(self)
+
+    def _after_fork(self):
+        """Reset in a child process after a fork.
+
+        The child has none of the parent's threads and shares the cached sockets with the parent,
+        so the cache starts over empty. The transports are made inactive, so that nothing (e.g.,
+        the close of a garbage collected channel) is sent on the parent's connections, and are
+        dropped without being closed, closing a proxy command would kill the parent's process.
+        """
+        super(SSHConnectionCache, self)._after_fork()
+        for entry in list(self.ssh_socket_entries.values()):
+            entry.sshsock.active = False
+        self.shards = {}
+        self.ssh_socket_entries = {}
+        self.pending_count = 0
+        self.ssh_sockets_lock = threading.Lock()
+        self.room_cv = threading.Condition(self.ssh_sockets_lock)
+        self.room_waiters = 0
+        self.room_changes = 0
+        self.counters = _CacheStats()
+        if self.close_policy is not None:
+            self.close_policy._after_fork()  # pylint: disable=W0212
+        self.reaper = _ExpiryReaper(self)
+        # The parent's selector (e.g., epoll) must not be modified by the child.
+        self.monitor.selector.close()
+        self.monitor = _LivenessMonitor(self, self.monitor.interval)
+
+    def _lock_shard(self, key):
+        """Return the shard for `key` locked, creating it if needed."""
+        while True:
+            shard = self.shards.get(key)
+            if shard is None:
+                with self.ssh_sockets_lock:
+                    shard = self.shards.get(key)
+                    if shard is None:
+                        shard = _KeyShard(key)
+                        self.shards[key] = shard
+            shard.lock.acquire()
+            if not shard.removed:
+                return shard
+            shard.lock.release()
+
+    def _unlock_shard(self, shard):
+        """Unlock `shard` removing it from the cache if it is no longer used."""
+        try:
+            unused = not shard.entries and shard.pending is None and not shard.room_waiters
+            if unused and not shard.removed:
+                with self.ssh_sockets_lock:
+                    shard.removed = True
+                    del self.shards[shard.key]
+                    self.counters.hits += shard.hits
+                    self.counters.waits += shard.waits
+                # Anyone waiting must look the key up again.
+                shard.cv.notify_all()
+        finally:
+            shard.lock.release()
+
+    def _reserve_socket(self):
+        """Reserve room for a new socket within `max_sockets`.
+
+        Must enter with the cache lock unlocked, the reservation is given back when the connect
+        completes.
+
+        :return: True if the socket may be opened.
+        """
+        with self.ssh_sockets_lock:
+            if self.max_sockets is not None:
+                if len(self.ssh_socket_entries) + self.pending_count >= self.max_sockets:
+                    return False
+            self.pending_count += 1
+            return True
+
+    def _room_changed(self):
+        """Wake the requesters waiting for room within `max_sockets`.
 
-    def get_ssh_socket(self, host, port, username, password, debug, proxycmd=None):
+        Must enter with the cache lock locked.
+        """
+        self.room_changes += 1
+        if self.room_waiters:
+            self.room_cv.notify_all()
+
+    def _wait_room(self, shard, changes, timeout):
+        """Wait for room within `max_sockets` unless it changed since `changes` was read.
+
+        Must enter with `shard` locked, it is unlocked while waiting and is locked on return.
+        """
+        shard.room_waiters += 1
+        shard.lock.release()
+        try:
+            with self.ssh_sockets_lock:
+                if self.room_changes == changes:
+                    self.room_waiters += 1
+                    try:
+                        # Sockets becoming unused only notify once they see us waiting, look for
+                        # one that became unused before that.
+                        if self._find_idle() is None:
+                            self.room_cv.wait(timeout)
+                    finally:
+                        self.room_waiters -= 1
+        finally:
+            shard.lock.acquire()
+            shard.room_waiters -= 1
+
+    def get_ssh_socket(self,
+                       host,
+                       port,
+                       username,
+                       password,
+                       debug,
+                       proxycmd=None,
+                       deadline=None,
+                       profile=None):
         """Returns a socket to the given host using the given credentials.
 
         If a socket has already been opened with the supplied arguments, then it will be reference
         counted and returned. Otherwise a new socket will be opened. If `usernamee` is `None` getpass
         will be used to obtain the current user name.
 
+        Each set of arguments has its own lock so requests for different hosts don't contend. New
+        sockets are opened without holding any lock. Concurrent callers for the same arguments
+        wait on a single pending connect, while connects to other hosts proceed in parallel.
+
         :param host: The hostname to connect to.
         :param port: The TCP port number to connect to.
         :param username: The username to use for authentication or `None`.
@@ -286,87 +1889,415 @@ class SSHConnectionCache(_SSHConnectionCache):
         :param password: The password/key for authentication or None.
         :param debug: Boolean indicating if debug messages should be enabled.
         :param proxycmd: A proxy command to use when making the ssh connection.
-        :raises: ssh.AuthenticationException
+        :param deadline: A `SSHDeadline` limiting the time spent waiting and connecting.
+        :param profile: The `SSHTransportProfile`, or name of one in `TRANSPORT_PROFILES`, to tune
+                        new sockets with. Sockets with different profiles are not shared.
+        :raises: ssh.AuthenticationException, SSHTimeoutError
 
         """
-        # Return an open ssh socket if we have one.
+        if _check_fork_pid and self.pid != os.getpid():
+            _after_fork_in_child()
+        profile = _transport_profile(profile)
+        key = (host, port, username, proxycmd, profile)
+        if deadline is None:
+            deadline = SSHDeadline()
+        wait_start = _now()
+        requested = self.close_policy is None
+        waited = False
+        while True:
+            shard = self._lock_shard(key)
+            try:
+                if not requested:
+                    self.close_policy.requested(key, wait_start)
+                    requested = True
+
+                # Return an open ssh socket if we have one.
+                entry = self._get_cached_entry(shard, debug)
+                if entry is not None:
+                    shard.hits += 1
+                    self._check_spares(shard, password, debug)
+                    return entry.sshsock
+
+                # If no one else is connecting to this key we will, otherwise wait for them.
+                pending = shard.pending
+                if pending is None:
+                    room = self._make_key_room(shard, debug)
+                    if room:
+                        changes = self.room_changes
+                        if self._reserve_socket():
+                            with self.ssh_sockets_lock:
+                                self.counters.misses += 1
+                            pending = _PendingConnect()
+                            shard.pending = pending
+                            break
+                        if self._evict_idle(shard, debug):
+                            continue
+                    if debug:
+                        logger.debug("All ssh sockets busy for %s, waiting", str(key))
+                    if not waited:
+                        shard.waits += 1
+                        waited = True
+                    timeout = deadline.remaining("wait", wait_start)
+                    if room:
+                        # Room within `max_sockets` is made by the other keys' sockets.
+                        self._wait_room(shard, changes, timeout)
+                    else:
+                        shard.cv.wait(timeout)
+                    continue
+                if not waited:
+                    shard.waits += 1
+                    waited = True
+            finally:
+                self._unlock_shard(shard)
 
-        key = "{}:{}@{}:{}".format(host, port, username, proxycmd)
-        with self.ssh_sockets_lock:
             if debug:
-                logger.debug("Searching for \"%s\" in open ssh socket cache", key)
-            if key in self.ssh_sockets:
-                for entry in self.ssh_sockets[key]:
-                    # Check if we have too many open channels on this socket or if the socket is
-                    if entry[2] >= self.max_channels:
-                        continue
+                logger.debug("Waiting on pending connect for %s", str(key))
+            if not pending.event.wait(deadline.remaining("wait", wait_start)):
+                raise deadline.timed_out("wait")
+            if pending.error is not None:
+                if pending.spare:
+                    # No one asked for the spare, try again and connect ourselves if need be.
+                    continue
+                raise pending.error  # pylint: disable=E0702
 
-                    # Make sure the session is still active, the remote side may have closed.
-                    # XXX Hard to tell if the OS socket is closed on us. I'm not sure if
-                    # is_active() here covers this. If the remote side closes the socket
-                    # (e.g., the server exits) we don't want to use it anymore, but I'm not
-                    # sure how to handle this case.
-                    if not entry[1].is_active():
-                        logger.debug("entry is not active")
-                        continue
+        # Connect without holding the lock so other keys (and cache hits) aren't blocked by a slow
+        # or unreachable host.
+        return self._open_entry(shard, password, debug, deadline, pending).sshsock
 
-                    if _socket_is_remote_closed(entry[0]):
-                        logger.debug("entry's socket is remote closed")
-                        continue
+    def _open_entry(self, shard, password, debug, deadline, pending, spare=False):
+        """Open a socket for `shard` and add it to the cache completing `pending`.
 
-                    sshsock = entry[1]
-                    entry[2] += 1
-                    if debug:
-                        logger.debug("Incremented SSH socket use to %s", str(entry[2]))
+        Must enter unlocked with room reserved by `_reserve_socket`.
+
+        :param spare: If True the entry is added unused, otherwise with one user.
+        :return: The new entry.
+        """
+        key = shard.key
+        host, port, username, proxycmd, profile = key
+        start = _now()
+        try:
+            # True below is to use users ssh config, should this be part of get_ssh_socket
+            # API?
+            ossock, sshsock = self._open_ssh_socket(host, port, username, password, True, debug,
+                                                    proxycmd, deadline, profile)
+        except Exception as error:
+            shard.lock.acquire()
+            try:
+                with self.ssh_sockets_lock:
+                    self.counters.connect_errors += 1
+                    self.pending_count -= 1
+                    self._room_changed()
+                shard.pending = None
+                shard.cv.notify_all()
+            finally:
+                self._unlock_shard(shard)
+            pending.error = error
+            pending.event.set()
+            raise
+
+        if self.keepalive:
+            sshsock.set_keepalive(self.keepalive)
+        entry = _CacheEntry(key, shard, ossock, sshsock)
+        elapsed = _now() - start
+        with shard.lock:
+            shard.pending = None
+            # Add this socket to the sockets for this key
+            shard.entries[sshsock] = entry
+            with self.ssh_sockets_lock:
+                self.counters.handshake.observe(elapsed)
+                self.pending_count -= 1
+                self.ssh_socket_entries[sshsock] = entry
+            self.monitor.register(entry)
+            if spare:
+                entry.count = 0
+                self._schedule_close_socket_expire(entry, debug)
+            self._check_spares(shard, password, debug)
+            shard.cv.notify_all()
+        pending.event.set()
+        return entry
+
+    def _key_min_spares(self, key):
+        """Return the number of spare sockets to keep for `key`"""
+        if self.host_min_spares:
+            for hkey in (key[:2], key[0]):
+                if hkey in self.host_min_spares:
+                    return self.host_min_spares[hkey]
+        return self.min_spares
+
+    def _check_spares(self, shard, password, debug):
+        """Start opening a spare socket for `shard` in the background if it needs one.
+
+        Must enter with the shard locked.
+        """
+        key = shard.key
+        min_spares = self._key_min_spares(key)
+        if not min_spares or shard.pending is not None:
+            return
+        entries = shard.entries
+        if not entries:
+            return
+        used = 0
+        channels = 0
+        for entry in entries.values():
+            if entry.count:
+                used += 1
+                channels += entry.count
+        if len(entries) - used >= min_spares:
+            return
+        max_channels = self.host_max_channels.get(key[:2], self.max_channels)
+        if not used or channels < self.spare_threshold * max_channels * used:
+            return
+        # Spares never evict other sockets.
+        if self.max_key_sockets is not None and len(entries) >= self.max_key_sockets:
+            return
+        if not self._reserve_socket():
+            return
 
-                    # Cancel any timeout for closing, only really need to do this on count == 1.
-                    self._cancel_close_socket_expire(sshsock, debug)
+        if debug:
+            logger.debug("Opening spare ssh socket for %s", str(key))
+        with self.ssh_sockets_lock:
+            self.counters.spares += 1
+        pending = _PendingConnect(spare=True)
+        shard.pending = pending
+        thread = threading.Thread(
+            target=self._open_spare, args=(shard, password, debug, pending), name="SSHCacheSpare")
+        thread.daemon = True
+        thread.start()
+
+    def _open_spare(self, shard, password, debug, pending):
+        try:
+            self._open_entry(shard, password, debug, SSHDeadline(), pending, spare=True)
+        except Exception as error:  # pylint: disable=W0703
+            logger.info("%s: Opening spare ssh socket for %s failed: %s", str(self),
+                        str(shard.key[0]), str(error))
+
+    def prewarm(self,
+                hosts,
+                concurrency=16,
+                port=22,
+                username=None,
+                password=None,
+                debug=False,
+                proxycmd=None,
+                timeout=None,
+                profile=None):
+        """Open and authenticate sockets to many hosts in parallel.
+
+        The sockets are left unused in the cache (subject to `close_timeout`) so that the first
+        command to each host does not need to connect.
+
+        :param hosts: The hosts to connect to. Each host is either a hostname or a dictionary of
+                      `get_ssh_socket` arguments (host, port, username, password and proxycmd)
+                      which override the defaults given to this method.
+        :param concurrency: The maximum number of connects to run at the same time.
+        :param port: The default TCP port number to connect to.
+        :param username: The default username or `None` for `getpass.getuser()`.
+        :param password: The default password/key for authentication or None.
+        :param debug: Boolean indicating if debug messages should be enabled.
+        :param proxycmd: The default proxy command to use when making the ssh connection.
+        :param timeout: The time allowed for connecting to each host or `None` for no limit.
+        :param profile: The `SSHTransportProfile` or its name to tune the sockets with.
+        :return: A list of `PrewarmResult` in the same order as `hosts`.
+        """
+        defaults = dict(port=port, username=username, password=password, proxycmd=proxycmd)
+        work = []
+        for host in hosts:
+            args = dict(defaults)
+            if isinstance(host, dict):
+                args.update(host)
+            else:
+                args["host"] = host
+            # Match the key SSHConnection will use.
+            if not args["username"]:
+                args["username"] = getpass.getuser()
+            work.append(args)
 
-                    return sshsock
+        results = [None] * len(work)
 
-                # This means there are no entries with free channels
+        def prewarm(idx, args):
+            error = None
+            start = _now()
+            try:
+                sshsock = self.get_ssh_socket(args["host"], args["port"], args["username"],
+                                              args["password"], debug, args["proxycmd"],
+                                              SSHDeadline(timeout), profile)
+                self.release_ssh_socket(sshsock, debug)
+            except Exception as ex:  # pylint: disable=W0703
+                logger.debug("%s: prewarm of %s failed: %s", str(self), str(args["host"]), str(ex))
+                error = ex
+            results[idx] = PrewarmResult(args["host"], args["port"], args["username"], error,
+                                         _now() - start)
+
+        for thread in _start_workers(work, concurrency, prewarm, "SSHCachePrewarm"):
+            thread.join()
+        return results
+
+    def _make_key_room(self, shard, debug):
+        """Check if a new socket can be opened within `max_key_sockets` closing an unused one if
+        needed.
+
+        Must enter with the shard locked.
+
+        :return: True if a new socket can be opened.
+        """
+        if self.max_key_sockets is not None:
+            if len(shard.entries) >= self.max_key_sockets:
+                if not shard.idle:
+                    return False
+                entry = next(iter(shard.idle))
                 if debug:
-                    logger.debug("Entries for %s are maxed or closed", key)
+                    logger.debug("Evicting least recently used ssh socket for %s", str(shard.key))
+                with self.ssh_sockets_lock:
+                    self.counters.evictions += 1
+                self._close_socket(entry, debug)
+        return True
 
-            # True below is to use users ssh config, should this be part of get_ssh_socket
-            # API?
-            ossock, sshsock = _SSHConnectionCache._open_ssh_socket(host, port, username, password,
-                                                                   True, debug, proxycmd)
+    def _evict_idle(self, shard, debug):
+        """Close the least recently used unused socket to make room within `max_sockets`.
 
-            if key not in self.ssh_sockets:
-                self.ssh_sockets[key] = []
-            # Add this socket to the list of sockets for this key
-            self.ssh_sockets[key].append([ossock, sshsock, 1])
-            self.ssh_socket_keys[sshsock] = key
-            return sshsock
+        Must enter with `shard` locked, it is unlocked while closing the socket of another key so
+        that only one shard lock is ever waited for at a time, and is locked on return.
 
-    def _cancel_close_socket_expire(self, ssh_socket, debug):
-        """Must enter locked"""
-        if not ssh_socket:
-            return
-        if ssh_socket not in self.ssh_socket_timeout:
-            return
+        :return: True if a socket was closed.
+        """
+        with self.ssh_sockets_lock:
+            victim = self._find_idle()
+        if victim is None:
+            return False
+
+        if victim.shard is not shard:
+            shard.lock.release()
+            try:
+                victim_shard = victim.shard
+                victim_shard.lock.acquire()
+                closed = self._evict_entry(victim, debug)
+                self._unlock_shard(victim_shard)
+            finally:
+                shard.lock.acquire()
+            return closed
+        return self._evict_entry(victim, debug)
+
+    def _find_idle(self):
+        """Return the least recently used unused entry of all the shards or `None`.
+
+        Must enter with the cache lock locked. The shards are read without being locked, so the
+        entry must be checked again with its shard locked.
+        """
+        oldest = None
+        for shard in self.shards.values():
+            try:
+                entry = next(iter(shard.idle))
+            except (StopIteration, RuntimeError):
+                # No unused entries, or they changed as we looked.
+                continue
+            if oldest is None or entry.idle_since < oldest.idle_since:
+                oldest = entry
+        return oldest
+
+    def _evict_entry(self, entry, debug):
+        """Must enter with the entry's shard locked"""
+        # It may have been used or closed by the time we locked it.
+        if entry.expire is None or self.ssh_socket_entries.get(entry.sshsock) is not entry:
+            return False
         if debug:
-            logger.debug("Canceling timer to release ssh socket: %s", str(ssh_socket))
-        timer = self.ssh_socket_timeout[ssh_socket]
-        del self.ssh_socket_timeout[ssh_socket]
-        timer.cancel()
+            logger.debug("Evicting least recently used ssh socket for %s", str(entry.key))
+        with self.ssh_sockets_lock:
+            self.counters.evictions += 1
+        self._close_socket(entry, debug)
+        return True
 
-    def _close_socket_expire(self, ssh_socket, debug):
-        if not ssh_socket:
+    def _get_cached_entry(self, shard, debug):
+        """Must enter with the shard locked"""
+        key = shard.key
+        if debug:
+            logger.debug("Searching for %s in open ssh socket cache", str(key))
+        entries = shard.entries
+        if not entries:
+            return None
+
+        # Use the least loaded live socket with a free channel, spares only once the sockets in
+        # use are full.
+        max_channels = self.host_max_channels.get(key[:2], self.max_channels)
+        spares = self._key_min_spares(key)
+        best = None
+        best_rank = None
+        for entry in entries.values():
+            if entry.count >= max_channels:
+                continue
+            rank = entry.count if entry.count or not spares else max_channels
+            if best is not None and rank >= best_rank:
+                continue
+
+            # Make sure the session is still active, the remote side may have closed. The
+            # transport notices when it reads EOF and the liveness monitor notices closed idle
+            # sockets.
+            if entry.dead or not entry.sshsock.is_active():
+                logger.debug("entry is not active")
+                continue
+
+            best = entry
+            best_rank = rank
+
+        if best is not None:
+            best.count += 1
+            if debug:
+                logger.debug("Incremented SSH socket use to %s", str(best.count))
+
+            # Cancel any timeout for closing, only really need to do this on count == 1.
+            self._cancel_close_socket_expire(best, debug)
+
+            return best
+
+        # This means there are no entries with free channels
+        if debug:
+            logger.debug("Entries for %s are maxed or closed", str(key))
+        return None
+
+    def _cancel_close_socket_expire(self, entry, debug):
+        """Must enter with the entry's shard locked.
+
+        The reaper's deadline is left for the reaper to drop when it is reached.
+        """
+        if entry.expire is None:
             return
+        if debug:
+            logger.debug("Canceling timer to release ssh socket: %s", str(entry.sshsock))
+        entry.expire = None
+        del entry.shard.idle[entry]
+
+    def _close_socket_expire(self, entry, deadline):
+        """Called by the reaper thread when a deadline is reached."""
+        shard = entry.shard
+        shard.lock.acquire()
+        try:
+            # If we don't have this deadline anymore it was replaced or the socket closed.
+            if entry.scheduled != deadline:
+                return
+            entry.scheduled = None
+            # In use again, the next release schedules a new deadline.
+            if entry.expire is None:
+                return
+            # Used and released again since it was scheduled, catch up with its deadline.
+            if entry.expire > deadline:
+                entry.scheduled = entry.expire
+                self.reaper.schedule(entry.expire, entry)
+                return
 
-        with self.ssh_sockets_lock:
-            # If we aren't present anymore must have been canceled
-            if ssh_socket not in self.ssh_socket_timeout:
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if self._keep_spare(entry):
+                if debug:
+                    logger.debug("Keeping spare ssh socket: %s", str(entry.sshsock))
+                self._schedule_close_socket_expire(entry, debug)
                 return
 
             if debug:
-                logger.debug("Timer expired, releasing ssh socket: %s", str(ssh_socket))
+                logger.debug("Timer expired, releasing ssh socket: %s", str(entry.sshsock))
 
-            # Remove any timeout
-            del self.ssh_socket_timeout[ssh_socket]
-            self._close_socket(ssh_socket, debug)
+            with self.ssh_sockets_lock:
+                self.counters.expirations += 1
+            self._close_socket(entry, debug)
+        finally:
+            self._unlock_shard(shard)
 
     def release_ssh_socket(self, ssh_socket, debug):
         """Release a refrence on an open socket.
@@ -374,100 +2305,265 @@ class SSHConnectionCache(_SSHConnectionCache):
         `release_ssh_socket` must be paired with each call to `get_ssh_socket`."""
         if not ssh_socket:
             return
+        if _check_fork_pid and self.pid != os.getpid():
+            _after_fork_in_child()
 
-        with self.ssh_sockets_lock:
-            key = self.ssh_socket_keys[ssh_socket]
+        entry = self.ssh_socket_entries.get(ssh_socket)
+        if entry is None:
+            # A socket from before a fork, the parent owns its transport so just drop it.
+            if debug:
+                logger.debug("Dropping untracked ssh socket: %s", str(ssh_socket))
+            return
+        shard = entry.shard
+        shard.lock.acquire()
+        try:
+            self._release_ssh_socket(ssh_socket, debug)
+        finally:
+            self._unlock_shard(shard)
+
+    def _release_ssh_socket(self, ssh_socket, debug):
+        """Must enter with the socket's shard locked"""
+        entry = self.ssh_socket_entries[ssh_socket]
+
+        entry.count -= 1
+        entry.shard.cv.notify_all()
+        if entry.shard.room_waiters:
+            # A waiter for room may use the free channel.
+            with self.ssh_sockets_lock:
+                self._room_changed()
+        if entry.count:
+            if debug:
+                logger.debug("Decremented SSH socket use to %s", str(entry.count))
+            return
 
-            assert key in self.ssh_sockets
-            entry = None
-            for entry in self.ssh_sockets[key]:
-                if entry[1] == ssh_socket:
-                    break
-            else:
-                raise KeyError("Can't find {} in list of entries".format(key))
+        # We are all done with this socket
+        if self.close_policy is not None:
+            self.close_policy.released(entry.key, _now())
 
-            entry[2] -= 1
-            if entry[2]:
+        # Setup a timer to actually close the socket.
+        if entry.expire is None:
+            if entry.dead or not ssh_socket.is_active():
                 if debug:
-                    logger.debug("Decremented SSH socket use to %s", str(entry[2]))
-                return
+                    logger.debug("Immediate release of inactive ssh socket: %s", str(ssh_socket))
+                if not entry.dead:
+                    with self.ssh_sockets_lock:
+                        self.counters.dead += 1
+                self._close_socket(entry, debug)
+            else:
+                self._schedule_close_socket_expire(entry, debug)
 
-            # We are all done with this socket
-            # Setup a timer to actually close the socket.
-            if ssh_socket not in self.ssh_socket_timeout:
-                inactive = not ssh_socket.is_active()
-                if inactive or _socket_is_remote_closed(entry[0]):
-                    if debug:
-                        if inactive:
-                            logger.debug("Immediate release of inactive ssh socket: %s",
-                                         str(ssh_socket))
-                        else:
-                            logger.debug("Immediate release of remote closed ssh socket: %s",
-                                         str(ssh_socket))
-                    self._close_socket(ssh_socket, debug)
-                else:
-                    if debug:
-                        logger.debug("Setting up timer to release ssh socket: %s", str(ssh_socket))
-                    self.ssh_socket_timeout[ssh_socket] = threading.Timer(
-                        self.close_timeout, self._close_socket_expire, [ssh_socket, debug])
-                    self.ssh_socket_timeout[ssh_socket].start()
+    def _schedule_close_socket_expire(self, entry, debug):
+        """Must enter with the entry's shard locked"""
+        if debug:
+            logger.debug("Setting up timer to release ssh socket: %s", str(entry.sshsock))
+        now = _now()
+        if self.close_policy is None:
+            entry.expire = now + self.close_timeout
+        else:
+            entry.expire = now + self.close_policy.timeout(entry.key)
+        entry.idle_since = now
+        # Only tell the reaper if it has no deadline for the entry or a later one (e.g., the
+        # timeout adapted), otherwise it catches up with this deadline when it reaches its own.
+        if entry.scheduled is None or entry.expire < entry.scheduled:
+            entry.scheduled = entry.expire
+            self.reaper.schedule(entry.expire, entry)
+        # A rescheduled spare moves to the most recently used end.
+        entry.shard.idle.pop(entry, None)
+        entry.shard.idle[entry] = None
+        if self.room_waiters:
+            # An unused socket can be evicted to make room.
+            with self.ssh_sockets_lock:
+                self._room_changed()
+
+    def _keep_spare(self, entry):
+        """Return True if unused `entry` is needed as a spare for sockets still in use.
+
+        Must enter with the entry's shard locked.
+        """
+        min_spares = self._key_min_spares(entry.key)
+        if not min_spares or entry.dead or not entry.sshsock.is_active():
+            return False
+        entries = entry.shard.entries
+        unused = 0
+        for other in entries.values():
+            if not other.count:
+                unused += 1
+        return unused < len(entries) and unused <= min_spares
+
+    def channel_limit(self, host, port):
+        """Return the number of channels opened on one socket to a host.
+
+        This is `max_channels` unless a lower limit has been learned for the host.
+        """
+        return self.host_max_channels.get((host, port), self.max_channels)
+
+    def channel_open_failed(self, ssh_socket, debug):
+        """Release a socket on which the server refused to open another channel.
+
+        The number of channels the socket had open is remembered as the limit for the host so
+        later requests will use (or open) another socket.
 
-    def _close_socket(self, ssh_socket, debug):
-        entry = None
+        :return: True if the caller should retry with a new socket from `get_ssh_socket`.
+        """
+        if _check_fork_pid and self.pid != os.getpid():
+            _after_fork_in_child()
+        entry = self.ssh_socket_entries.get(ssh_socket)
+        if entry is None:
+            self.release_ssh_socket(ssh_socket, debug)
+            return False
+        with entry.shard.lock:
+            hostport = entry.key[:2]
+            limit = entry.count - 1
+            if limit > 0:
+                if limit < self.host_max_channels.get(hostport, self.max_channels):
+                    logger.info("%s: Learned channel limit of %d for %s:%s", str(self), limit,
+                                str(hostport[0]), str(hostport[1]))
+                    self.host_max_channels[hostport] = limit
+        self.release_ssh_socket(ssh_socket, debug)
+        return limit > 0
+
+    def _socket_dead(self, entry):
+        """Called by the liveness monitor when the remote side has closed an entry's socket."""
+        shard = entry.shard
+        shard.lock.acquire()
         try:
-            key = self.ssh_socket_keys[ssh_socket]
-            for entry in self.ssh_sockets[key]:
-                if entry[1] == ssh_socket:
-                    break
-            else:
-                assert False
+            if self.ssh_socket_entries.get(entry.sshsock) is not entry:
+                return
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug("Remote closed ssh socket to %s", str(entry.key))
+            entry.dead = True
+            with self.ssh_sockets_lock:
+                self.counters.dead += 1
+            if not entry.count:
+                self._close_socket(entry, debug)
+        finally:
+            self._unlock_shard(shard)
+
+    def _close_socket(self, entry, debug):
+        """Must enter with the entry's shard locked.
 
+        The shard is left in the cache even if this was its last socket, `_unlock_shard` removes
+        it.
+        """
+        key = entry.key
+        bastion = getattr(entry.ossock, "bastion", None)
+        self.monitor.unregister(entry)
+        try:
             if debug:
                 logger.debug("Closing SSH socket to %s", str(key))
-            if entry[1]:
-                entry[1].close()
-                entry[1] = None
-
-            if entry[0]:
-                entry[0].close()
-                entry[0] = None
+            entry.sshsock.close()
+            if entry.ossock:
+                entry.ossock.close()
         except Exception as error:
             logger.info("%s: Unexpected exception: %s: %s", str(self), str(error),
                         traceback.format_exc())
             logger.error("%s: Unexpected error closing socket:  %s", str(self), str(error))
         finally:
-            del self.ssh_socket_keys[ssh_socket]
-            if entry:
-                self.ssh_sockets[key].remove(entry)
+            if entry.scheduled is not None:
+                self.reaper.cancel(entry)
+                entry.scheduled = None
+            if entry.expire is not None:
+                entry.expire = None
+                del entry.shard.idle[entry]
+            entry.ossock = None
+            with self.ssh_sockets_lock:
+                del self.ssh_socket_entries[entry.sshsock]
+                self._room_changed()
+            del entry.shard.entries[entry.sshsock]
+            entry.shard.cv.notify_all()
+            # Release the jump host transport this socket was using. The bastion's shard is
+            # locked while holding ours, this is safe as the bastion never waits on its targets.
+            if bastion is not None and bastion in self.ssh_socket_entries:
+                self.release_ssh_socket(bastion, debug)
 
     def flush(self, debug=False):
         """Flush (close) any un-referenced open entries currently waiting for timeout."""
-        # XXX change this when we create a class
+        # Copy the entries as closing removes them.
+        for entry in list(self.ssh_socket_entries.values()):
+            if entry.expire is None:
+                continue
+            shard = entry.shard
+            shard.lock.acquire()
+            try:
+                if entry.expire is None or self.ssh_socket_entries.get(entry.sshsock) is not entry:
+                    continue
+                if debug:
+                    logger.debug("Flush: canceling and releasing ssh socket: %s",
+                                 str(entry.sshsock))
+                self._close_socket(entry, debug)
+            finally:
+                self._unlock_shard(shard)
+
+    def stats(self):
+        """Return a snapshot of the cache statistics.
+
+        The counters are cumulative for the life of the cache. The result is a dictionary with the
+        counters `hits`, `misses`, `waits` (for a busy or pending socket), `evictions`,
+        `expirations`, `dead` (sockets discarded as closed by the remote side), `connect_errors`
+        and `spares` (spare sockets opened in the background); the gauges `hit_rate` (hits over
+        hits and misses), `sockets` and `channels` (in use); `keys`, a list of per host, port and
+        username dictionaries with their own `sockets`, `channels` and `close_timeout` (the time
+        an unused socket is kept open); and `handshake_seconds`, a histogram of the time taken to
+        open and authenticate sockets. `format_prometheus` will format the result for scraping.
+
+        The shards are read without being locked so the snapshot is not exact while the cache is
+        in use.
+        """
         with self.ssh_sockets_lock:
-            for key in self.ssh_sockets:
-                for entry in self.ssh_sockets[key]:
-                    ssh_socket = entry[1]
-                    try:
-                        timer = self.ssh_socket_timeout[ssh_socket]
-                    except KeyError:
-                        continue
-                    if timer is None:
-                        continue
-                    if debug:
-                        logger.debug("Flush: canceling and releasing ssh socket: %s",
-                                     str(ssh_socket))
-                    timer.cancel()
-                    del self.ssh_socket_timeout[ssh_socket]
-                    self._close_socket(ssh_socket, debug)
+            shards = list(self.shards.values())
+            stats = self.counters.snapshot(shards)
+        keys = []
+        channels = 0
+        for shard in shards:
+            entries = list(shard.entries.values())
+            if not entries:
+                continue
+            key = shard.key
+            key_channels = sum(entry.count for entry in entries)
+            channels += key_channels
+            keys.append(
+                dict(
+                    host=key[0],
+                    port=key[1],
+                    username=key[2],
+                    proxycmd=None if key[3] is None else str(key[3]),
+                    profile=None if key[4] is None else key[4].name,
+                    sockets=len(entries),
+                    channels=key_channels,
+                    close_timeout=self.close_timeout
+                    if self.close_policy is None else self.close_policy.timeout(key)))
+        stats.update(sockets=len(self.ssh_socket_entries), channels=channels, keys=keys)
+        return stats
 
     def __str__(self):
         "Return a nice string for the cache object"
-        return "SSHConnectionCache(\"{}\", close_timeout={}, max_channels={})".format(
-            self.desc, self.close_timeout, self.max_channels)
+        return ("SSHConnectionCache(\"{}\", close_timeout={}, max_channels={}, max_sockets={}, "
+                "max_key_sockets={})".format(self.desc, self.close_timeout, self.max_channels,
+                                             self.max_sockets, self.max_key_sockets))
+
+
+# Caches to reset in a child process after a fork.
+_fork_caches = weakref.WeakSet()
+
+# Without fork hooks the caches check for a changed pid when used.
+_check_fork_pid = not hasattr(os, "register_at_fork")
+
+
+def _after_fork_in_child():
+    """Reset the caches, and what they share, in a child process after a fork."""
+    _SSHConnectionCache.resolver._after_fork()  # pylint: disable=W0212
+    if _SSHConnectionCache.ssh_config is not None:
+        _SSHConnectionCache.ssh_config._after_fork()  # pylint: disable=W0212
+    for cache in list(_fork_caches):
+        cache._after_fork()  # pylint: disable=W0212
+
+
+if not _check_fork_pid:
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
 
 def _setup_travis():
-    import getpass
     import sys
     global _private_key  # pylint: disable=W0603
 
@@ -15,11 +15,20 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import codecs
+import collections
+import functools
 import logging
+import mmap
+import multiprocessing
 import os
+import select
+import socket
 import subprocess
+import tempfile
+import threading
 from sshutil import conn
-from sshutil.cache import _setup_travis
+from sshutil.cache import _now, _setup_travis, _start_workers, SSHTimeoutError
 
 __author__ = 'Christian Hopps'
 __version__ = '1.0'
@@ -27,6 +36,10 @@ __docformat__ = "restructuredtext en"
 
 logger = logging.getLogger(__name__)
 
+# The number of commands `SSHCommand.run_many` runs at once by default when each has a connection
+# of its own, this stays below OpenSSH's default MaxStartups of 10 unauthenticated connections.
+_MAX_PARALLEL_CONNECTS = 8
+
 
 def setup_module(_):
     _setup_travis()
@@ -42,6 +55,43 @@ class CalledProcessError(subprocess.CalledProcessError):
             self.args = [code, command, output, error]
 
 
+class CommandResult(
+        collections.namedtuple("CommandResult",
+                               "command status output error_output exception elapsed")):
+    """The result of running one of a batch of commands.
+
+    `status`, `output` and `error_output` are as returned by `run_status_stderr`. `exception` is
+    the exception raised running the command (`status` is then `None`) or `None`, and `elapsed` is
+    the time taken in seconds.
+    """
+    __slots__ = ()
+
+
+def _run_many(factory, commands, max_parallel):
+    """Run commands on up to `max_parallel` threads.
+
+    :param factory: Called with each command to get the command object to run.
+    :return: A list of `CommandResult` in the same order as `commands`.
+    """
+    commands = list(commands)
+    results = [None] * len(commands)
+
+    def run(idx, command):
+        status = output = error_output = exception = None
+        start = _now()
+        try:
+            status, output, error_output = factory(command).run_status_stderr()
+        except Exception as ex:  # pylint: disable=W0703
+            logger.debug("Running %s failed: %s", str(command), str(ex))
+            exception = ex
+        results[idx] = CommandResult(command, status, output, error_output, exception,
+                                     _now() - start)
+
+    for thread in _start_workers(commands, max_parallel, run, "SSHRunMany"):
+        thread.join()
+    return results
+
+
 def read_to_eof(recvmethod):
     buf = recvmethod(conn.MAXSSHBUF)
     while buf:
@@ -49,6 +99,228 @@ def read_to_eof(recvmethod):
         buf = recvmethod(conn.MAXSSHBUF)
 
 
+class HostResult(
+        collections.namedtuple("HostResult", "host status output error_output exception elapsed")):
+    """The result of running a command on one of many hosts.
+
+    `host` is the host as given to `run_hosts`. `status`, `output` and `error_output` are as
+    returned by `run_status_stderr`. `exception` is the exception raised running the command
+    (`status` is then `None`) or `None`, and `elapsed` is the time taken in seconds.
+    """
+    __slots__ = ()
+
+
+def run_hosts(hosts, command, concurrency=16, ordered=False, timeout=None, **kwargs):
+    """Run a command on many hosts at the same time yielding the results as they complete.
+
+    Pass a shared `SSHConnectionCache` as `cache` to reuse connections across runs.
+
+    :param hosts: The hosts to run the command on. Each host is a hostname, a dictionary of
+                  `SSHCommand` arguments (host, port, username, password etc.) which override
+                  `kwargs`, or an object with a `run_status_stderr(command)` method such as a
+                  `Host`, which is passed the time left as `timeout` when there is a limit.
+    :param command: The shell command to run.
+    :param concurrency: The maximum number of hosts to run the command on at once.
+    :param ordered: If True yield the results in the order of `hosts` rather than as they
+                    complete.
+    :param timeout: The time allowed for the whole run or `None` for no limit. Connecting is
+                    limited to the time left and hosts that haven't finished when it runs out
+                    get a result with a `SSHTimeoutError` (phase "command"), their commands
+                    are left to finish in the background.
+    :param kwargs: Other `SSHCommand` arguments, e.g., port, username, password and cache.
+    :return: An iterator over `HostResult`.
+    """
+    hosts = list(hosts)
+    expire = None if timeout is None else _now() + timeout
+    completed = []
+    completed_cv = threading.Condition()
+    started = {}
+    started_lock = threading.Lock()
+    stop = []
+
+    def take(idx):
+        # No host is started once the time has run out.
+        with started_lock:
+            now = _now()
+            if stop or (expire is not None and now >= expire):
+                return False
+            started[idx] = now
+            return True
+
+    def run(idx, host):
+        start = started[idx]
+        status = output = error_output = exception = None
+        try:
+            args = {}
+            if expire is not None:
+                args["timeout"] = expire - start
+            if hasattr(host, "run_status_stderr"):
+                status, output, error_output = host.run_status_stderr(command, **args)
+            else:
+                args = dict(kwargs, **args)
+                if isinstance(host, dict):
+                    args.update(host)
+                else:
+                    args["host"] = host
+                status, output, error_output = SSHCommand(command, **args).run_status_stderr()
+        except Exception as ex:  # pylint: disable=W0703
+            logger.debug("Running %s on %s failed: %s", str(command), str(host), str(ex))
+            exception = ex
+        result = HostResult(host, status, output, error_output, exception, _now() - start)
+        with completed_cv:
+            completed.append((idx, result))
+            completed_cv.notify()
+
+    _start_workers(hosts, concurrency, run, "SSHRunHosts", take)
+
+    pending = set(range(0, len(hosts)))
+    held = {}
+    next_idx = 0
+    try:
+        while pending:
+            with completed_cv:
+                while not completed:
+                    if expire is None:
+                        completed_cv.wait()
+                    elif expire <= _now():
+                        break
+                    else:
+                        completed_cv.wait(expire - _now())
+                batch = list(completed)
+                del completed[:]
+            if not batch:
+                break
+            for idx, result in batch:
+                pending.discard(idx)
+                if ordered:
+                    held[idx] = result
+                else:
+                    yield result
+            while next_idx in held:
+                yield held.pop(next_idx)
+                next_idx += 1
+
+        # Out of time, the rest are (in order) held results, results that completed since we
+        # last looked and those not finished.
+        with completed_cv:
+            stop.append(True)
+            batch = list(completed)
+            del completed[:]
+        for idx, result in batch:
+            pending.discard(idx)
+            held[idx] = result
+        with started_lock:
+            now = _now()
+            for idx in pending:
+                held[idx] = HostResult(hosts[idx], None, None, None,
+                                       SSHTimeoutError("command", timeout),
+                                       now - started.get(idx, now))
+        for idx in sorted(held):
+            yield held[idx]
+    finally:
+        stop.append(True)
+
+
+def _split_lines(chunks):
+    """Split ``(name, data)`` chunks into ``(name, line)`` keeping the line endings.
+
+    Partial lines are held per stream so interleaved stdout and stderr don't mix.
+    """
+    partial = {"stdout": [], "stderr": []}
+    for name, data in chunks:
+        pieces = partial[name]
+        start = 0
+        end = data.find(b"\n") + 1
+        while end:
+            pieces.append(data[start:end])
+            yield name, b"".join(pieces)
+            del pieces[:]
+            start = end
+            end = data.find(b"\n", start) + 1
+        if start < len(data):
+            pieces.append(data[start:])
+    for name in ("stdout", "stderr"):
+        if partial[name]:
+            yield name, b"".join(partial[name])
+
+
+def _dispatch_chunks(chunks, stdout_cb, stderr_cb):
+    """Pass the data of ``(name, data)`` chunks to `stdout_cb` or, if not `None`, `stderr_cb`."""
+    for name, data in chunks:
+        if name == "stdout":
+            stdout_cb(data)
+        elif stderr_cb is not None:
+            stderr_cb(data)
+
+
+class SpooledOutput(object):
+    """Command output kept in memory up to a size and then spilled to a temporary file.
+
+    Read it through `file`, or use `mmap` to access spilled output without reading it in.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: The number of bytes to hold in memory before spilling to a file.
+        """
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+        self._mmap = None
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        """Return the output as bytes."""
+        self.file.seek(0)
+        return self.file.read()
+
+    def mmap(self):
+        """Return a read-only memory map of the output (an empty bytes if there is no output).
+
+        Output still in memory is first spilled to the file.
+        """
+        if self._mmap is None:
+            if not self.size:
+                return b""
+            self.file.rollover()
+            self.file.flush()
+            self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return "SpooledOutput({} bytes)".format(self.size)
+
+
+def _spool_output(chunks, max_size):
+    """Write ``(name, data)`` chunks to a `SpooledOutput` for each stream.
+
+    :return: (stdout, stderr) positioned at the start.
+    """
+    output = {"stdout": SpooledOutput(max_size), "stderr": SpooledOutput(max_size)}
+    for name, data in chunks:
+        output[name].write(data)
+    for spool in output.values():
+        spool.file.seek(0)
+    return output["stdout"], output["stderr"]
+
+
 def terminal_size():
     import fcntl
     import termios
@@ -84,7 +356,12 @@ class SSHCommand(conn.SSHConnection):
                  password=None,
                  debug=False,
                  cache=None,
-                 proxycmd=None):
+                 proxycmd=None,
+                 timeout=None,
+                 phase_timeouts=None,
+                 profile=None,
+                 encoding="utf-8",
+                 spool_size=None):
         """An command to execute over an ssh connection.
 
         :param command: The shell command to execute.
@@ -98,14 +375,25 @@ class SSHCommand(conn.SSHConnection):
         :param cache: A connection cache to use.
         :type cache: SSHConnectionCache
         :param proxycmd: Proxy command to use when making the ssh connection.
+        :param timeout: The overall time allowed for connecting or `None` for no limit.
+        :param phase_timeouts: A dictionary of the time allowed for each phase of connecting, see
+                               `SSHDeadline`.
+        :param profile: The `SSHTransportProfile` or its name to tune the ssh connection with.
+        :param encoding: The encoding to decode output with or `None` to leave it as bytes, e.g.,
+                         for binary output such as tarballs.
+        :param spool_size: If not `None` the output is returned as `SpooledOutput` which spills
+                           to a temporary file past this many bytes, `encoding` is not applied.
         """
         self.command = command
+        self.encoding = encoding
+        self.spool_size = spool_size
         self.exit_code = None
-        self.output = ""
+        self.output = "" if encoding else b""
         self.debug = debug
-        self.error_output = ""
+        self.error_output = self.output
 
-        super(SSHCommand, self).__init__(host, port, username, password, debug, cache, proxycmd)
+        super(SSHCommand, self).__init__(host, port, username, password, debug, cache, proxycmd,
+                                         timeout, phase_timeouts, profile)
 
     def _get_pty(self):
         width, height = terminal_size()
@@ -136,6 +424,74 @@ class SSHCommand(conn.SSHConnection):
         >>> print(error, end="")
         grep: doesnt-exist: No such file or directory
         """
+        output = {"stdout": [], "stderr": []}
+        if self.spool_size is not None:
+            self.output, self.error_output = _spool_output(self.stream(), self.spool_size)
+        elif self.encoding:
+            # Decode as we go, a character may be split across chunks.
+            decoders = {
+                "stdout": codecs.getincrementaldecoder(self.encoding)(),
+                "stderr": codecs.getincrementaldecoder(self.encoding)()
+            }
+            for name, data in self.stream():
+                output[name].append(decoders[name].decode(data))
+            for name, decoder in decoders.items():
+                output[name].append(decoder.decode(b"", True))
+            self.output = "".join(output["stdout"])
+            self.error_output = "".join(output["stderr"])
+        else:
+            for name, data in self.stream():
+                output[name].append(data)
+            self.output = b"".join(output["stdout"])
+            self.error_output = b"".join(output["stderr"])
+
+        if self.debug:
+            logger.debug("RESULT: exit: %s stdout: '%s' stderr: '%s'", str(self.exit_code),
+                         str(self.output), str(self.error_output))
+        return (self.exit_code, self.output, self.error_output)
+
+    def _recv_streams(self):
+        """Yield ``("stdout", data)`` and ``("stderr", data)`` from the channel as each arrives.
+
+        :raises: socket.timeout if the channel has a timeout and no data arrives within it.
+        """
+        chan = self.chan
+        timeout = chan.gettimeout()
+        while not chan.eof_received and not chan.closed:
+            ready = False
+            if chan.recv_ready():
+                ready = True
+                yield "stdout", chan.recv(conn.MAXSSHBUF)
+            if chan.recv_stderr_ready():
+                ready = True
+                yield "stderr", chan.recv_stderr(conn.MAXSSHBUF)
+            if not ready:
+                # The channel's fileno is readable when data or EOF arrives on either stream.
+                if not select.select([chan], [], [], timeout)[0]:
+                    raise socket.timeout("Timed out waiting for command output")
+        # stdout is all buffered now, stderr may still be arriving (e.g., over a mux).
+        for data in read_to_eof(chan.recv):
+            yield "stdout", data
+        for data in read_to_eof(chan.recv_stderr):
+            yield "stderr", data
+
+    def stream(self, lines=False):
+        """Run the command yielding its output as it arrives.
+
+        stdout and stderr are read as data arrives on either, so the command never stalls
+        writing to one while we wait on the other and memory use doesn't grow with the amount
+        of output. `exit_code` is set once the output has been consumed.
+
+        :param lines: If True yield whole lines (with line endings) rather than chunks.
+        :return: An iterator over ``(name, data)`` where name is "stdout" or "stderr" and data
+                 is bytes.
+
+        >>> cmd = SSHCommand("echo foo; echo bar >&2", "localhost")
+        >>> sorted(cmd.stream(lines=True))
+        [('stderr', b'bar\\n'), ('stdout', b'foo\\n')]
+        >>> cmd.exit_code
+        0
+        """
         if self.debug:
             logger.debug("RUNNING: %s", str(self.command))
 
@@ -143,19 +499,52 @@ class SSHCommand(conn.SSHConnection):
             if isinstance(self, SSHPTYCommand):
                 self._get_pty()
             self.chan.exec_command(self.command)
+            chunks = self._recv_streams()
+            if lines:
+                chunks = _split_lines(chunks)
+            for item in chunks:
+                yield item
             self.exit_code = self.chan.recv_exit_status()
-
-            self.output = "".join([x.decode('utf-8') for x in read_to_eof(self.chan.recv)])
-            self.error_output = "".join(
-                [x.decode('utf-8') for x in read_to_eof(self.chan.recv_stderr)])
-
-            if self.debug:
-                logger.debug("RESULT: exit: %s stdout: '%s' stderr: '%s'", str(self.exit_code),
-                             str(self.output), str(self.error_output))
-            return (self.exit_code, self.output, self.error_output)
         finally:
             self.close()
 
+    def run_status_callback(self, stdout_cb, stderr_cb=None, lines=False):
+        """Run the command passing its output to callbacks as it arrives.
+
+        :param stdout_cb: Called with each chunk (or line) of stdout as bytes.
+        :param stderr_cb: Called with each chunk (or line) of stderr as bytes, if `None` stderr
+                          is discarded.
+        :param lines: If True call with whole lines (with line endings) rather than chunks.
+        :return: The exit code.
+        """
+        _dispatch_chunks(self.stream(lines), stdout_cb, stderr_cb)
+        return self.exit_code
+
+    @classmethod
+    def run_many(cls, commands, host, max_parallel=None, **kwargs):
+        """Run many commands on a host at the same time.
+
+        Each command runs on its own channel. By default as many run at once as the cache opens
+        channels on one socket, so the commands share a cached transport and their channel opens
+        and execs overlap rather than each waiting on the previous one.
+
+        :param commands: The shell commands to execute.
+        :param host: The host to execute the commands on.
+        :param max_parallel: The maximum number of commands to run at once, if `None` the
+                             `channel_limit` of the cache for the host, or 8 if the cache opens
+                             a connection for each command.
+        :param kwargs: Other `SSHCommand` arguments, e.g., port, username, password and cache.
+        :return: A list of `CommandResult` in the same order as `commands`.
+        """
+        if max_parallel is None:
+            cache = kwargs.get("cache")
+            if cache is None:
+                cache = conn.g_cache
+            max_parallel = cache.channel_limit(host, kwargs.get("port", 22))
+            if max_parallel is None:
+                max_parallel = _MAX_PARALLEL_CONNECTS
+        return _run_many(functools.partial(cls, host=host, **kwargs), commands, max_parallel)
+
     def run_stderr(self):
         """
         Run a command, return stdout and stderr,
@@ -221,12 +610,22 @@ class SSHPTYCommand(SSHCommand):
 
 
 class ShellCommand(object):
-    def __init__(self, command, debug=False):
+    def __init__(self, command, debug=False, encoding="utf-8", spool_size=None):
+        """A command to execute in a local shell.
+
+        :param command: The shell command to execute.
+        :param debug: True to enable debug level logging.
+        :param encoding: The encoding to decode output with or `None` to leave it as bytes.
+        :param spool_size: If not `None` the output is returned as `SpooledOutput` which spills
+                           to a temporary file past this many bytes, `encoding` is not applied.
+        """
         self.command_list = ["/bin/sh", "-c", command]
         self.debug = debug
+        self.encoding = encoding
+        self.spool_size = spool_size
         self.exit_code = None
-        self.output = ""
-        self.error_output = ""
+        self.output = "" if encoding else b""
+        self.error_output = self.output
 
     def run_status_stderr(self):
         """
@@ -250,14 +649,23 @@ class ShellCommand(object):
         grep: doesnt-exist: No such file or directory
         """
         try:
-            if self.debug:
-                logger.debug("RUNNING: %s", str(self.command_list))
-            pipe = subprocess.Popen(
-                self.command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            output, error_output = pipe.communicate()
-            self.output = output.decode('utf-8')
-            self.error_output = error_output.decode('utf-8')
-            self.exit_code = pipe.returncode
+            if self.spool_size is not None:
+                self.output, self.error_output = _spool_output(self.stream(), self.spool_size)
+            else:
+                if self.debug:
+                    logger.debug("RUNNING: %s", str(self.command_list))
+                pipe = subprocess.Popen(
+                    self.command_list,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    close_fds=True)
+                output, error_output = pipe.communicate()
+                if self.encoding:
+                    output = output.decode(self.encoding)
+                    error_output = error_output.decode(self.encoding)
+                self.output = output
+                self.error_output = error_output
+                self.exit_code = pipe.returncode
         except OSError as error:
             logger.debug("RESULT: OSError: %s stdout: '%s' stderr: '%s'", str(error),
                          str(self.output), str(self.error_output))
@@ -269,6 +677,80 @@ class ShellCommand(object):
 
         return (self.exit_code, self.output, self.error_output)
 
+    def _read_pipes(self, pipe):
+        """Yield ``("stdout", data)`` and ``("stderr", data)`` from the pipes as each arrives."""
+        names = {pipe.stdout.fileno(): "stdout", pipe.stderr.fileno(): "stderr"}
+        try:
+            while names:
+                for fd in select.select(list(names), [], [])[0]:
+                    data = os.read(fd, conn.MAXSSHBUF)
+                    if data:
+                        yield names[fd], data
+                    else:
+                        del names[fd]
+        finally:
+            pipe.stdout.close()
+            pipe.stderr.close()
+            if names and pipe.poll() is None:
+                # Abandoned before the output was consumed.
+                pipe.kill()
+            self.exit_code = pipe.wait()
+
+    def stream(self, lines=False):
+        """Run the command yielding its output as it arrives.
+
+        stdout and stderr are read as data arrives on either, so memory use doesn't grow with
+        the amount of output. `exit_code` is set once the output has been consumed.
+
+        :param lines: If True yield whole lines (with line endings) rather than chunks.
+        :return: An iterator over ``(name, data)`` where name is "stdout" or "stderr" and data
+                 is bytes.
+
+        >>> cmd = ShellCommand("echo foo; echo bar >&2; exit 3")
+        >>> sorted(cmd.stream(lines=True))
+        [('stderr', b'bar\\n'), ('stdout', b'foo\\n')]
+        >>> cmd.exit_code
+        3
+        """
+        if self.debug:
+            logger.debug("RUNNING: %s", str(self.command_list))
+        pipe = subprocess.Popen(
+            self.command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        chunks = self._read_pipes(pipe)
+        if lines:
+            chunks = _split_lines(chunks)
+        for item in chunks:
+            yield item
+
+    def run_status_callback(self, stdout_cb, stderr_cb=None, lines=False):
+        """Run the command passing its output to callbacks as it arrives.
+
+        :param stdout_cb: Called with each chunk (or line) of stdout as bytes.
+        :param stderr_cb: Called with each chunk (or line) of stderr as bytes, if `None` stderr
+                          is discarded.
+        :param lines: If True call with whole lines (with line endings) rather than chunks.
+        :return: The exit code.
+        """
+        _dispatch_chunks(self.stream(lines), stdout_cb, stderr_cb)
+        return self.exit_code
+
+    @classmethod
+    def run_many(cls, commands, max_parallel=None, **kwargs):
+        """Run many commands at the same time.
+
+        :param commands: The shell commands to execute.
+        :param max_parallel: The maximum number of commands to run at once, if `None` the number
+                             of CPUs.
+        :param kwargs: Other `ShellCommand` arguments, e.g., encoding.
+        :return: A list of `CommandResult` in the same order as `commands`.
+
+        >>> [r.output for r in ShellCommand.run_many(["echo foo", "echo bar"])]
+        ['foo\\n', 'bar\\n']
+        """
+        if max_parallel is None:
+            max_parallel = multiprocessing.cpu_count()
+        return _run_many(functools.partial(cls, **kwargs), commands, max_parallel)
+
     def run_stderr(self):
         """
         Run a command over an ssh channel, return stdout and stderr,
@@ -17,8 +17,10 @@
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 import getpass
 import logging
+import paramiko as ssh
 
 from . import g_cache
+from .cache import _now, SSHDeadline
 
 __author__ = 'Christian Hopps'
 __version__ = '1.0'
@@ -46,7 +48,15 @@ def shell_escape_single_quote(command):
 
 
 class SSHConnection(object):
-    """A connection to an SSH server"""
+    """A connection to an SSH server
+
+    :param timeout: The overall time allowed for opening the connection or `None` for no limit.
+    :param phase_timeouts: A dictionary of the time allowed for each phase of opening the
+                           connection, see `SSHDeadline`. If a limit is exceeded
+                           `SSHTimeoutError` is raised.
+    :param profile: The `SSHTransportProfile`, or the name of one in `TRANSPORT_PROFILES`, to tune
+                    the ssh connection with.
+    """
 
     def __init__(self,
                  host,
@@ -55,7 +65,10 @@ class SSHConnection(object):
                  password=None,
                  debug=False,
                  cache=None,
-                 proxycmd=None):
+                 proxycmd=None,
+                 timeout=None,
+                 phase_timeouts=None,
+                 profile=None):
         if cache is None:
             cache = g_cache
 
@@ -72,16 +85,45 @@ class SSHConnection(object):
 
         self.username = username
 
-        self.ssh = cache.get_ssh_socket(host, port, username, password, debug, proxycmd)
-
-        # Open a session.
-        try:
-            if self.debug:
-                logger.debug("Opening SSH channel on socket (%s:%s)", self.host, str(self.port))
-            self.chan = self.ssh.open_session()
-        except:
-            self.close()
-            raise
+        deadline = SSHDeadline(timeout, phase_timeouts)
+        retry = True
+        while True:
+            self.ssh = cache.get_ssh_socket(host, port, username, password, debug, proxycmd,
+                                            deadline, profile)
+
+            # Open a session.
+            channel_start = _now()
+            try:
+                if self.debug:
+                    logger.debug("Opening SSH channel on socket (%s:%s)", self.host, str(self.port))
+                self.chan = self.ssh.open_session(timeout=deadline.remaining("channel"))
+                break
+            except ssh.ChannelException as error:
+                # The server refused another channel on this socket, the cache will lower its
+                # channel limit for the host so a retry will use a different socket.
+                tmp = self.ssh
+                self.ssh = None
+                if not cache.channel_open_failed(tmp, self.debug):
+                    self.close()
+                    raise
+                logger.debug("SSH channel refused on socket (%s:%s), retrying: %s", self.host,
+                             str(self.port), str(error))
+            except Exception as error:
+                # A cached socket may have been closed by the remote side after we got it, if so
+                # drop it and try once more with a new socket.
+                if retry and not self.ssh.is_active():
+                    logger.debug("SSH socket (%s:%s) closed opening channel, retrying: %s",
+                                 self.host, str(self.port), str(error))
+                    retry = False
+                    self.close()
+                    continue
+                self.close()
+                # Report paramiko's channel open timeout as ours.
+                deadline.remaining("channel", channel_start)
+                raise
+            except:
+                self.close()
+                raise
 
     def __del__(self):
         # Make sure we get rid of the cached reference to the open ssh socket
@@ -139,7 +181,10 @@ class SSHClientSession(SSHSession):
                  password=None,
                  debug=False,
                  cache=None,
-                 proxycmd=None):
+                 proxycmd=None,
+                 timeout=None,
+                 phase_timeouts=None,
+                 profile=None):
         """Opens a client session to a host using a given subsystem.
 
         :param host: The host to execute the command on.
@@ -153,9 +198,13 @@ class SSHClientSession(SSHSession):
         :param cache: A connection cache to use.
         :type cache: SSHConnectionCache
         :param proxycmd: Proxy command to use when making the ssh connection.
+        :param timeout: The overall time allowed for connecting or `None` for no limit.
+        :param phase_timeouts: A dictionary of the time allowed for each phase of connecting, see
+                               `SSHDeadline`.
+        :param profile: The `SSHTransportProfile` or its name to tune the ssh connection with.
         """
         super(SSHClientSession, self).__init__(host, port, username, password, debug, cache,
-                                               proxycmd)
+                                               proxycmd, timeout, phase_timeouts, profile)
         try:
             self.chan.invoke_subsystem(subsystem)
         except:
@@ -178,7 +227,10 @@ class SSHCommandSession(SSHSession):
                  password=None,
                  debug=False,
                  cache=None,
-                 proxycmd=None):
+                 proxycmd=None,
+                 timeout=None,
+                 phase_timeouts=None,
+                 profile=None):
         """Open a client session to a host using a command i.e., like a remote pipe
 
         :param host: The host to execute the command on.
@@ -192,9 +244,13 @@ class SSHCommandSession(SSHSession):
         :param cache: A connection cache to use.
         :type cache: SSHConnectionCache
         :param proxycmd: Proxy command to use when making the ssh connection.
+        :param timeout: The overall time allowed for connecting or `None` for no limit.
+        :param phase_timeouts: A dictionary of the time allowed for each phase of connecting, see
+                               `SSHDeadline`.
+        :param profile: The `SSHTransportProfile` or its name to tune the ssh connection with.
         """
         super(SSHCommandSession, self).__init__(host, port, username, password, debug, cache,
-                                                proxycmd)
+                                                proxycmd, timeout, phase_timeouts, profile)
         try:
             self.chan.exec_command(command)
         except:
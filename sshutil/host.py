@@ -38,7 +38,10 @@ class Host(object):
                  password=None,
                  debug=False,
                  cache=None,
-                 proxycmd=None):
+                 proxycmd=None,
+                 timeout=None,
+                 phase_timeouts=None,
+                 profile=None):
         """Get a 'connection' to a host (local or remote)
 
         :param server: The host to execute commands on `None` for using the local shell.
@@ -52,6 +55,12 @@ class Host(object):
         :param cache: A connection cache to use.
         :type cache: SSHConnectionCache
         :param proxycmd: Proxy command to use when making the ssh connection.
+        :param timeout: The overall time allowed for each ssh connection or `None` for no limit.
+        :param phase_timeouts: A dictionary of the time allowed for each phase of connecting, see
+                               `SSHDeadline`.
+        :param profile: The `SSHTransportProfile`, or the name of one in `TRANSPORT_PROFILES`, to
+                        tune ssh connections with, e.g., "bulk-throughput" for large output and
+                        file copies.
         """
 
         self.sftp = None
@@ -66,7 +75,10 @@ class Host(object):
                 password=password,
                 debug=debug,
                 cache=cache,
-                proxycmd=proxycmd)
+                proxycmd=proxycmd,
+                timeout=timeout,
+                phase_timeouts=phase_timeouts,
+                profile=profile)
             self.session_class = functools.partial(
                 SSHClientSession,
                 host=server,
@@ -75,7 +87,10 @@ class Host(object):
                 password=password,
                 debug=debug,
                 cache=cache,
-                proxycmd=proxycmd)
+                proxycmd=proxycmd,
+                timeout=timeout,
+                phase_timeouts=phase_timeouts,
+                profile=profile)
         else:
             self.cmd_class = functools.partial(ShellCommand, debug=debug)
             self.session_class = None
@@ -101,9 +116,14 @@ class Host(object):
     def _get_cmd(self, command):
         return "bash -c 'cd {} && {}'".format(self.cwd, shell_escape_single_quote(command))
 
-    def run_status_stderr(self, command):
+    def run_status_stderr(self, command, encoding="utf-8", spool_size=None, timeout=None):
         """Run the command returning exit code, stdout and stderr.
 
+        :param encoding: The encoding to decode output with or `None` to return bytes.
+        :param spool_size: If not `None` return output as `SpooledOutput` which spills to a
+                           temporary file past this many bytes.
+        :param timeout: If not `None` the time allowed for the ssh connection when less than the
+                        host's `timeout`, ignored for the local host.
         :return: (returncode, stdout, stderr)
 
         >>> host = Host()
@@ -121,31 +141,75 @@ class Host(object):
         >>> print(error, end="")
         grep: doesnt-exist: No such file or directory
         """
-        return self.cmd_class(self._get_cmd(command)).run_status_stderr()
+        kwargs = dict(encoding=encoding, spool_size=spool_size)
+        if timeout is not None and self.session_class:
+            host_timeout = self.cmd_class.keywords["timeout"]
+            if host_timeout is None or timeout < host_timeout:
+                kwargs["timeout"] = timeout
+        return self.cmd_class(self._get_cmd(command), **kwargs).run_status_stderr()
+
+    def stream(self, command, lines=False):
+        """Run a command yielding its output as it arrives.
+
+        :param lines: If True yield whole lines (with line endings) rather than chunks.
+        :return: An iterator over ``(name, data)`` where name is "stdout" or "stderr" and data
+                 is bytes.
+        """
+        return self.cmd_class(self._get_cmd(command)).stream(lines)
 
-    def run_status(self, command):
+    def run_status(self, command, encoding="utf-8", spool_size=None):
         """Run a command, return exitcode and stdout.
 
+        :param encoding: The encoding to decode output with or `None` to return bytes.
+        :param spool_size: If not `None` return output as `SpooledOutput` which spills to a
+                           temporary file past this many bytes.
         :return: (status, stdout)
         """
-        return self.cmd_class(self._get_cmd(command)).run_status()
+        return self.cmd_class(
+            self._get_cmd(command), encoding=encoding, spool_size=spool_size).run_status()
 
-    def run_stderr(self, command):
+    def run_stderr(self, command, encoding="utf-8", spool_size=None):
         """Run a command, return stdout and stderr,
 
+        :param encoding: The encoding to decode output with or `None` to return bytes.
+        :param spool_size: If not `None` return output as `SpooledOutput` which spills to a
+                           temporary file past this many bytes.
         :return: (stdout, stderr)
         :raises: CalledProcessError
         """
-        return self.cmd_class(self._get_cmd(command)).run_stderr()
+        return self.cmd_class(
+            self._get_cmd(command), encoding=encoding, spool_size=spool_size).run_stderr()
 
-    def run(self, command):
+    def run(self, command, encoding="utf-8", spool_size=None):
         """Run a command, return stdout.
 
+        :param encoding: The encoding to decode output with or `None` to return bytes.
+        :param spool_size: If not `None` return output as `SpooledOutput` which spills to a
+                           temporary file past this many bytes.
         :return: stdout
         :raises: CalledProcessError
         """
 
-        return self.cmd_class(self._get_cmd(command)).run()
+        return self.cmd_class(
+            self._get_cmd(command), encoding=encoding, spool_size=spool_size).run()
+
+    def run_many(self, commands, max_parallel=None, encoding="utf-8", spool_size=None):
+        """Run many commands at the same time.
+
+        :param commands: The commands to run.
+        :param max_parallel: The maximum number of commands to run at once, if `None` see
+                             `SSHCommand.run_many` for a remote host or the number of CPUs for
+                             the local host.
+        :param encoding: The encoding to decode output with or `None` to return bytes.
+        :param spool_size: If not `None` return output as `SpooledOutput` which spills to a
+                           temporary file past this many bytes.
+        :return: A list of `CommandResult` in the same order as `commands`.
+        """
+        kwargs = dict(self.cmd_class.keywords, encoding=encoding, spool_size=spool_size)
+        results = self.cmd_class.func.run_many([self._get_cmd(x) for x in commands],
+                                               max_parallel=max_parallel,
+                                               **kwargs)
+        return [result._replace(command=command) for result, command in zip(results, commands)]
 
     def copy_to(self, localfile, remotefile):
         if self.session_class:
@@ -0,0 +1,658 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# October 16 2026, Christian Hopps <chopps@gmail.com>
+#
+# Copyright (c) 2026, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Share cached ssh connections between processes (like OpenSSH ControlMaster).
+
+A `SSHMuxServer` owns a `SSHConnectionCache` and listens on a unix domain socket. Other
+processes use a `SSHMuxCache` as their cache, each channel they open is opened by the server
+and relayed over its own unix socket connection.
+
+The relay protocol is a sequence of frames each with a one byte type and four byte length
+header. A client first sends an `_OPEN` frame with the connection arguments (or a "stats" or
+"channel_limit" query) as JSON and receives a `_REPLY`. It then sends `_REQUEST` frames (exec,
+subsystem, shell or pty) each answered by a `_REPLY`, and stdin as `_DATA` and `_EOF` frames.
+The server sends stdout as `_DATA` frames, stderr as `_STDERR` frames, `_EOF` at end of stdout
+and finally `_EXIT` with the exit status.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import argparse
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import threading
+import paramiko as ssh
+from sshutil.cache import _now, _SSHConnectionCache, _transport_profile, SSHConnectionCache
+from sshutil.cache import SSHJumpHost
+from sshutil.cache import SSHTimeoutError, SSHTransportProfile
+from sshutil.conn import SSHConnection
+
+__author__ = 'Christian Hopps'
+__date__ = 'October 16 2026'
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
+
+logger = logging.getLogger(__name__)
+
+_OPEN = 1
+_REPLY = 2
+_REQUEST = 3
+_DATA = 4
+_STDERR = 5
+_EOF = 6
+_EXIT = 7
+
+_HEADER = struct.Struct("!BI")
+_MAXFRAME = 16 * 1024 * 1024
+
+
+def _send_frame(sock, ftype, payload=b""):
+    sock.sendall(_HEADER.pack(ftype, len(payload)) + payload)
+
+
+def _send_json(sock, ftype, obj):
+    _send_frame(sock, ftype, json.dumps(obj).encode('utf-8'))
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_frame(sock):
+    """Return (type, payload) of the next frame or (None, None) if the peer closed."""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None, None
+    ftype, size = _HEADER.unpack(header)
+    if size > _MAXFRAME:
+        raise ssh.SSHException("Mux frame too large: {}".format(size))
+    payload = _recv_exact(sock, size) if size else b""
+    if payload is None:
+        return None, None
+    return ftype, payload
+
+
+def _check_password(password):
+    if hasattr(password, "get_name"):
+        raise ValueError("Only passwords can be sent to the mux server")
+
+
+def _proxycmd_to_json(proxycmd):
+    if not isinstance(proxycmd, SSHJumpHost):
+        return proxycmd
+    _check_password(proxycmd.password)
+    return dict(
+        host=proxycmd.host,
+        port=proxycmd.port,
+        username=proxycmd.username,
+        password=proxycmd.password,
+        proxycmd=_proxycmd_to_json(proxycmd.proxycmd))
+
+
+def _proxycmd_from_json(proxycmd):
+    if not isinstance(proxycmd, dict):
+        return proxycmd
+    return SSHJumpHost(proxycmd["host"], proxycmd["port"], proxycmd["username"],
+                       proxycmd["password"], _proxycmd_from_json(proxycmd["proxycmd"]))
+
+
+def _profile_to_json(profile):
+    profile = _transport_profile(profile)
+    return None if profile is None else profile._asdict()
+
+
+def _profile_from_json(profile):
+    if profile is None:
+        return None
+    profile = dict((k, tuple(v) if isinstance(v, list) else v) for k, v in profile.items())
+    return SSHTransportProfile(**profile)
+
+
+def _error_reply(error):
+    reply = dict(error=str(error), type=error.__class__.__name__)
+    if isinstance(error, SSHTimeoutError):
+        reply.update(phase=error.phase, timeout=error.timeout)
+    return reply
+
+
+def _reply_error(reply):
+    """Return an exception to raise for an error `reply` from the server."""
+    etype = reply.get("type")
+    if etype == "SSHTimeoutError":
+        return SSHTimeoutError(reply["phase"], reply["timeout"])
+    if etype in ("AuthenticationException", "BadAuthenticationType"):
+        return ssh.AuthenticationException(reply["error"])
+    if etype == "ChannelException":
+        return ssh.ChannelException(ssh.OPEN_FAILED_RESOURCE_SHORTAGE, reply["error"])
+    if etype in ("ValueError", "TypeError"):
+        return ValueError(reply["error"])
+    if etype in ("OSError", "IOError", "error", "gaierror", "timeout", "ConnectionRefusedError",
+                 "ConnectionResetError", "TimeoutError"):
+        return socket.error(reply["error"])
+    return ssh.SSHException(reply["error"])
+
+
+class _MuxServerConnection(object):
+    """A client connection to a `SSHMuxServer` relaying a single channel."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.conn = None
+        self.pumps = []
+
+    def _send(self, ftype, payload=b""):
+        with self.send_lock:
+            _send_frame(self.sock, ftype, payload)
+
+    def _send_json(self, ftype, obj):
+        self._send(ftype, json.dumps(obj).encode('utf-8'))
+
+    def _open(self, args):
+        if args.get("op") == "stats":
+            self._send_json(_REPLY, dict(stats=self.server.cache.stats()))
+            return False
+        if args.get("op") == "channel_limit":
+            limit = self.server.cache.channel_limit(args["host"], args["port"])
+            self._send_json(_REPLY, dict(channel_limit=limit))
+            return False
+        try:
+            self.conn = SSHConnection(
+                args["host"],
+                args["port"],
+                args["username"],
+                args.get("password"),
+                self.server.debug,
+                self.server.cache,
+                _proxycmd_from_json(args.get("proxycmd")),
+                timeout=args.get("timeout"),
+                phase_timeouts=args.get("phase_timeouts"),
+                profile=_profile_from_json(args.get("profile")))
+        except Exception as error:  # pylint: disable=W0703
+            logger.debug("%s: open of %s failed: %s", str(self.server), str(args["host"]),
+                         str(error))
+            self._send_json(_REPLY, _error_reply(error))
+            return False
+        self._send_json(_REPLY, dict(ok=True))
+        return True
+
+    def _request(self, args):
+        chan = self.conn.chan
+        op = args["op"]
+        try:
+            if op == "exec":
+                chan.exec_command(args["command"])
+            elif op == "subsystem":
+                chan.invoke_subsystem(args["name"])
+            elif op == "shell":
+                chan.invoke_shell()
+            elif op == "pty":
+                chan.get_pty(args["term"], args["width"], args["height"])
+            else:
+                raise ValueError("Unknown mux request: {}".format(op))
+        except Exception as error:  # pylint: disable=W0703
+            self._send_json(_REPLY, _error_reply(error))
+            return
+        self._send_json(_REPLY, dict(ok=True))
+        if op != "pty" and not self.pumps:
+            self._start_pumps(chan)
+
+    def _start_pumps(self, chan):
+        for target, name in ((self._pump_stdout, "Stdout"), (self._pump_stderr, "Stderr")):
+            thread = threading.Thread(target=target, args=(chan, ), name="SSHMux" + name)
+            thread.daemon = True
+            self.pumps.append(thread)
+        for thread in self.pumps:
+            thread.start()
+
+    def _pump_stdout(self, chan):
+        try:
+            data = chan.recv(self.server.bufsize)
+            while data:
+                self._send(_DATA, data)
+                data = chan.recv(self.server.bufsize)
+            self._send(_EOF)
+            # Wait for stderr to drain so the exit status is last.
+            self.pumps[1].join()
+            self._send_json(_EXIT, dict(status=chan.recv_exit_status()))
+            with self.send_lock:
+                self.sock.shutdown(socket.SHUT_WR)
+        except (socket.error, EOFError) as error:
+            logger.debug("%s: stdout relay ended: %s", str(self.server), str(error))
+
+    def _pump_stderr(self, chan):
+        try:
+            data = chan.recv_stderr(self.server.bufsize)
+            while data:
+                self._send(_STDERR, data)
+                data = chan.recv_stderr(self.server.bufsize)
+        except (socket.error, EOFError) as error:
+            logger.debug("%s: stderr relay ended: %s", str(self.server), str(error))
+
+    def serve(self):
+        try:
+            ftype, payload = _recv_frame(self.sock)
+            if ftype != _OPEN or not self._open(json.loads(payload.decode('utf-8'))):
+                return
+            while True:
+                ftype, payload = _recv_frame(self.sock)
+                if ftype is None:
+                    break
+                elif ftype == _REQUEST:
+                    self._request(json.loads(payload.decode('utf-8')))
+                elif ftype == _DATA:
+                    self.conn.chan.sendall(payload)
+                elif ftype == _EOF:
+                    self.conn.chan.shutdown_write()
+        except Exception as error:  # pylint: disable=W0703
+            logger.debug("%s: client connection error: %s", str(self.server), str(error))
+        finally:
+            if self.conn is not None:
+                self.conn.close()
+            self.sock.close()
+            self.server.remove_connection(self)
+
+
+class SSHMuxServer(object):
+    """A daemon sharing the ssh connections in its cache with other processes.
+
+    Clients connect over a unix domain socket using `SSHMuxCache`. The socket is only accessible
+    by the user running the server.
+
+    :param path: The path of the unix domain socket to listen on.
+    :param cache: The `SSHConnectionCache` to open connections with, if `None` one is created.
+    :param debug: True to enable debug level logging.
+    """
+
+    bufsize = 32 * 1024
+
+    def __init__(self, path, cache=None, debug=False):
+        if cache is None:
+            cache = SSHConnectionCache("SSH mux server cache")
+        self.path = path
+        self.cache = cache
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.connections = []
+
+        # Remove a stale socket left by a server that exited without cleaning up.
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError("{} exists and is not a socket".format(path))
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise ValueError("A mux server is already listening on {}".format(path))
+            finally:
+                probe.close()
+
+        self.listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        omask = os.umask(0o177)
+        try:
+            self.listen_socket.bind(path)
+        finally:
+            os.umask(omask)
+        self.listen_socket.listen(100)
+
+        # Create a socket to cause closure.
+        self.close_wsocket, self.close_rsocket = socket.socketpair()
+
+        self.thread = threading.Thread(None, self._accept_thread, name="SSHMuxAcceptThread")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        logger.info("Sending close signal to mux accept socket")
+        self.close_wsocket.send(b"!")
+
+    def join(self):
+        "Wait on server to terminate"
+        assert self.thread
+        self.thread.join()
+        self.thread = None
+
+    def remove_connection(self, connection):
+        with self.lock:
+            self.connections.remove(connection)
+
+    def _accept_thread(self):
+        try:
+            while True:
+                rfds, unused, unused = select.select([self.listen_socket, self.close_rsocket], [],
+                                                     [])
+                if self.close_rsocket in rfds:
+                    break
+                sock, unused = self.listen_socket.accept()
+                connection = _MuxServerConnection(self, sock)
+                with self.lock:
+                    self.connections.append(connection)
+                thread = threading.Thread(target=connection.serve, name="SSHMuxConnection")
+                thread.daemon = True
+                thread.start()
+        finally:
+            if self.debug:
+                logger.debug("%s: exiting accept thread", str(self))
+            self.listen_socket.close()
+            self.close_rsocket.close()
+            self.close_wsocket.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                try:
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.cache.flush()
+
+    def __str__(self):
+        return "SSHMuxServer({})".format(self.path)
+
+
+class _MuxChannel(object):
+    """The client side of a channel relayed by a `SSHMuxServer`.
+
+    This provides the subset of the `paramiko.Channel` interface used by sshutil.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = transport.sock
+        self.stdout = []
+        self.stderr = []
+        self.eof_received = False
+        self.exit_status = None
+        self.closed = False
+        self.timeout = None
+
+    def _read_frame(self, block=True):
+        """Read and dispatch one frame returning the frame type or `None` if none is ready."""
+        if not block and not select.select([self.sock], [], [], 0)[0]:
+            return None
+        ftype, payload = _recv_frame(self.sock)
+        if ftype is None:
+            self.eof_received = True
+            if self.exit_status is None:
+                self.exit_status = -1
+            self.closed = True
+        elif ftype == _DATA:
+            self.stdout.append(payload)
+        elif ftype == _STDERR:
+            self.stderr.append(payload)
+        elif ftype == _EOF:
+            self.eof_received = True
+        elif ftype == _EXIT:
+            self.exit_status = json.loads(payload.decode('utf-8'))["status"]
+            self.eof_received = True
+        return ftype
+
+    def _read_reply(self):
+        ftype, payload = _recv_frame(self.sock)
+        if ftype is None:
+            raise ssh.SSHException("Mux server closed connection")
+        assert ftype == _REPLY
+        reply = json.loads(payload.decode('utf-8'))
+        if "error" in reply:
+            raise _reply_error(reply)
+        return reply
+
+    def exec_command(self, command):
+        _send_json(self.sock, _REQUEST, dict(op="exec", command=command))
+        self._read_reply()
+
+    def invoke_subsystem(self, subsystem):
+        _send_json(self.sock, _REQUEST, dict(op="subsystem", name=subsystem))
+        self._read_reply()
+
+    def invoke_shell(self):
+        _send_json(self.sock, _REQUEST, dict(op="shell"))
+        self._read_reply()
+
+    def get_pty(self, term="vt100", width=80, height=24, width_pixels=0, height_pixels=0):
+        del width_pixels, height_pixels  # unused
+        _send_json(self.sock, _REQUEST, dict(op="pty", term=term, width=width, height=height))
+        self._read_reply()
+
+    def get_transport(self):
+        return self.transport
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.timeout
+
+    def send(self, data):
+        _send_frame(self.sock, _DATA, data)
+        return len(data)
+
+    def sendall(self, data):
+        _send_frame(self.sock, _DATA, data)
+
+    def shutdown_write(self):
+        _send_frame(self.sock, _EOF)
+
+    def _recv(self, buffers, size):
+        while not buffers:
+            if self.closed or (buffers is self.stdout and self.eof_received):
+                return b""
+            if buffers is self.stderr and self.exit_status is not None:
+                return b""
+            self._read_frame()
+        data = buffers[0]
+        if len(data) > size:
+            buffers[0] = data[size:]
+            return data[:size]
+        buffers.pop(0)
+        return data
+
+    def _ready(self, buffers):
+        while not buffers and not self.closed and self._read_frame(False) is not None:
+            pass
+        return bool(buffers)
+
+    def recv(self, nbytes):
+        return self._recv(self.stdout, nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._recv(self.stderr, nbytes)
+
+    def recv_ready(self):
+        return self._ready(self.stdout)
+
+    def recv_stderr_ready(self):
+        return self._ready(self.stderr)
+
+    def exit_status_ready(self):
+        while self.exit_status is None and self._read_frame(False) is not None:
+            pass
+        return self.exit_status is not None
+
+    def recv_exit_status(self):
+        while self.exit_status is None:
+            self._read_frame()
+        return self.exit_status
+
+    def close(self):
+        self.transport.close()
+        self.closed = True
+
+
+class _MuxTransport(object):
+    """The client side of a connection to a `SSHMuxServer` carrying one channel.
+
+    This provides the subset of the `paramiko.Transport` interface used by sshutil.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.chan = None
+
+    def open_session(self, window_size=None, max_packet_size=None, timeout=None):
+        del window_size, max_packet_size, timeout  # unused, the server opened the session
+        if self.chan is not None:
+            raise ssh.ChannelException(ssh.OPEN_FAILED_RESOURCE_SHORTAGE,
+                                       "Mux connections carry a single channel")
+        self.chan = _MuxChannel(self)
+        return self.chan
+
+    def is_active(self):
+        return self.sock is not None
+
+    def get_log_channel(self):
+        return __name__
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class SSHMuxCache(_SSHConnectionCache):
+    """A cache whose connections are opened by a `SSHMuxServer` in another process.
+
+    Use this as the `cache` argument of `SSHCommand`, `Host` etc. so that processes share the
+    server's cached ssh connections. Passwords (including those of `SSHJumpHost` bastions) are
+    passed to the server, keys are not; key authentication uses the server's ssh agent.
+
+    :param path: The path of the unix domain socket the server listens on.
+    """
+
+    def __init__(self, path, desc=""):
+        super(SSHMuxCache, self).__init__()
+        self.path = path
+        self.desc = desc
+
+    def _connect(self, args):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            _send_json(sock, _OPEN, args)
+            ftype, payload = _recv_frame(sock)
+            if ftype != _REPLY:
+                raise ssh.SSHException("Mux server closed connection")
+            reply = json.loads(payload.decode('utf-8'))
+            if "error" in reply:
+                raise _reply_error(reply)
+        except Exception:
+            sock.close()
+            raise
+        return sock, reply
+
+    def get_ssh_socket(self,
+                       host,
+                       port,
+                       username,
+                       password,
+                       debug,
+                       proxycmd=None,
+                       deadline=None,
+                       profile=None):
+        _check_password(password)
+        args = dict(
+            host=host,
+            port=port,
+            username=username,
+            password=password,
+            proxycmd=_proxycmd_to_json(proxycmd),
+            profile=_profile_to_json(profile))
+        if deadline is not None:
+            # The server starts a new deadline with what is left of ours.
+            phase_timeouts = dict(deadline.phase_timeouts)
+            if deadline.expire is not None:
+                remaining = deadline.expire - _now()
+                if remaining <= 0:
+                    raise deadline.timed_out("wait")
+                args["timeout"] = remaining
+                for phase, timeout in phase_timeouts.items():
+                    phase_timeouts[phase] = min(timeout, remaining)
+            args["phase_timeouts"] = phase_timeouts
+        if debug:
+            logger.debug("Opening mux connection to %s:%s through %s", str(host), str(port),
+                         self.path)
+        sock, unused = self._connect(args)
+        return _MuxTransport(sock)
+
+    def release_ssh_socket(self, ssh_socket, debug=False):
+        if debug:
+            logger.debug("Closing mux connection through %s", self.path)
+        ssh_socket.close()
+
+    def channel_limit(self, host, port):
+        """Return the number of channels the server's cache opens on one socket to a host."""
+        sock, reply = self._connect(dict(op="channel_limit", host=host, port=port))
+        sock.close()
+        return reply["channel_limit"]
+
+    def stats(self):
+        """Return the statistics of the server's cache, see `SSHConnectionCache.stats`."""
+        sock, reply = self._connect(dict(op="stats"))
+        sock.close()
+        return reply["stats"]
+
+    def flush(self, debug=False):  # pylint: disable=W0613
+        return
+
+    def __str__(self):
+        return "SSHMuxCache(\"{}\", {})".format(self.desc, self.path)
+
+
+def main(*margs):
+    parser = argparse.ArgumentParser("SSH connection sharing server")
+    parser.add_argument(
+        "--close-timeout", type=float, default=30, help="Seconds to keep unused connections open")
+    parser.add_argument(
+        "--max-channels", type=int, default=8, help="Maximum channels per connection")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging")
+    parser.add_argument("path", help="Path of the unix socket to listen on")
+    args = parser.parse_args(*margs)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    cache = SSHConnectionCache("SSH mux server cache", args.close_timeout, args.max_channels)
+    server = SSHMuxServer(args.path, cache, args.debug)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.close()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# October 16 2026, Christian Hopps <chopps@gmail.com>
+#
+# Copyright (c) 2026, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmark the cache hit path with many threads.
+
+Each thread repeatedly gets and releases a cached socket. With "shared" every thread uses the
+same host, so all of them contend on one lock, with "per-host" each thread uses its own host (a
+username on a local paramiko server) the way a fan-out over many devices does. Run from the top
+of the source tree::
+
+  $ PYTHONPATH=. python tests/bench_cache.py --threads 1 8 64 256
+
+With ``--max-sockets`` the cache is given a `max_sockets` limit, which it is kept within, to
+measure the hit path of a bounded cache.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import argparse
+import threading
+import time
+import paramiko as ssh
+from sshutil.cache import SSHConnectionCache
+import sshutil.server as server
+
+
+class AnyUserController(server.SSHUserPassController):
+    """Any username is accepted with the password."""
+
+    def check_auth_password(self, username, password):
+        if self.password == password:
+            return ssh.AUTH_SUCCESSFUL
+        return ssh.AUTH_FAILED
+
+
+def bench(cache, port, usernames, duration):
+    """Return the get/release pairs per second and the mean time of each pair in microseconds."""
+    counts = [0] * len(usernames)
+    start_event = threading.Event()
+    stop = []
+
+    def run(idx, username):
+        count = 0
+        start_event.wait()
+        while not stop:
+            for unused in range(0, 100):
+                sshsock = cache.get_ssh_socket("127.0.0.1", port, username, "admin", False)
+                cache.release_ssh_socket(sshsock, False)
+            count += 100
+        counts[idx] = count
+
+    threads = [
+        threading.Thread(target=run, args=(idx, username))
+        for idx, username in enumerate(usernames)
+    ]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    start_event.set()
+    time.sleep(duration)
+    stop.append(True)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    total = sum(counts)
+    return total / elapsed, elapsed * len(usernames) / total * 1e6
+
+
+def main(*margs):
+    parser = argparse.ArgumentParser("Benchmark the sshutil cache hit path")
+    parser.add_argument(
+        "--threads", type=int, nargs="+", default=[1, 8, 64, 256], help="Thread counts to run")
+    parser.add_argument("--duration", type=float, default=2, help="Seconds to run each test")
+    parser.add_argument(
+        "--max-sockets", action="store_true", help="Limit the cache to the sockets it needs")
+    args = parser.parse_args(*margs)
+
+    ns = server.SSHServer(AnyUserController(password="admin"), host_key="tests/host_key")
+    maxthreads = max(args.threads)
+    cache = SSHConnectionCache(
+        "bench cache",
+        close_timeout=3600,
+        max_channels=maxthreads + 1,
+        max_sockets=maxthreads + 1 if args.max_sockets else None)
+    hosts = ["127.0.0.1"]
+    hosts.extend(dict(host="127.0.0.1", username="user{}".format(i)) for i in range(0, maxthreads))
+    cache.prewarm(hosts, port=ns.port, password="admin", username="user0")
+
+    print("{:>8} {:>10} {:>14} {:>10}".format("threads", "hosts", "ops/s", "us/op"))
+    for nthreads in args.threads:
+        for name, usernames in (("shared", ["user0"] * nthreads),
+                                ("per-host", ["user{}".format(i) for i in range(0, nthreads)])):
+            rate, latency = bench(cache, ns.port, usernames, args.duration)
+            print("{:>8} {:>10} {:>14.0f} {:>10.1f}".format(nthreads, name, rate, latency))
+
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
+__author__ = 'Christian Hopps'
+__date__ = 'October 16 2026'
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 eval: (yapf-mode 1) -*-
+#
+# October 16 2026, Christian Hopps <chopps@gmail.com>
+#
+# Copyright (c) 2026, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Benchmark the transport profiles.
+
+For each profile this reports the time to open and authenticate a connection and the throughput
+of reading command output that is text (compressible) or binary (random). By default a local
+paramiko server is used, it does not support compression and shares the CPU with the client, so
+use --host to measure against a real ssh server. Run from the top of the source tree::
+
+  $ PYTHONPATH=. python tests/bench_profiles.py --size 16
+  $ PYTHONPATH=. python tests/bench_profiles.py --size 16 --host router1
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import argparse
+import getpass
+import os
+import time
+from sshutil.cache import SSHNoConnectionCache, TRANSPORT_PROFILES
+from sshutil.conn import SSHCommandSession
+import sshutil.server as server
+from testfunc import ExecController
+
+CHUNK = 32 * 1024
+COMMANDS = {
+    "text": "yes 'Oct 16 12:00:00 router1 bgpd[123]: neighbor 10.0.0.1 state change Up' | "
+    "head -c {}",
+    "binary": "head -c {} /dev/urandom",
+}
+
+
+class OutputController(ExecController):
+    """Commands "text N" and "binary N" output N bytes of that kind of data."""
+
+    text = b"".join(
+        "Oct 16 12:00:{:02} router{} bgpd[123]: neighbor 10.0.0.{} state change Up\n".format(
+            i % 60, i % 7, i % 255).encode('ascii') for i in range(0, 512))[:CHUNK]
+    binary = os.urandom(CHUNK)
+
+    def _exec(self, channel, command):
+        kind, size = command.decode('ascii').split()
+        data = getattr(self, kind)
+        size = int(size)
+        while size > 0:
+            channel.sendall(data[:size])
+            size -= len(data)
+        return 0
+
+
+def bench_connect(args, profile):
+    cache = SSHNoConnectionCache()
+    start = time.time()
+    for unused in range(0, args.repeat):
+        sshsock = cache.get_ssh_socket(args.host, args.port, args.username, args.password, False,
+                                       profile=profile)
+        cache.release_ssh_socket(sshsock)
+    return (time.time() - start) / args.repeat
+
+
+def bench_output(args, profile, command, size):
+    session = SSHCommandSession(
+        args.host,
+        args.port,
+        command.format(size),
+        username=args.username,
+        password=args.password,
+        cache=SSHNoConnectionCache(),
+        profile=profile)
+    start = time.time()
+    total = 0
+    data = session.recv(CHUNK)
+    while data:
+        total += len(data)
+        data = session.recv(CHUNK)
+    elapsed = time.time() - start
+    session.close()
+    assert total == size
+    return size / elapsed / (1024 * 1024)
+
+
+def main(*margs):
+    parser = argparse.ArgumentParser("Benchmark sshutil transport profiles")
+    parser.add_argument("--size", type=int, default=16, help="Megabytes of output to read")
+    parser.add_argument("--repeat", type=int, default=5, help="Connections to time")
+    parser.add_argument("--host", help="Server to use instead of a local paramiko server")
+    parser.add_argument("--port", type=int, default=22, help="Server port")
+    parser.add_argument("--username", default=getpass.getuser(), help="Server username")
+    parser.add_argument("--password", help="Server password (default: use ssh agent)")
+    args = parser.parse_args(*margs)
+
+    ns = None
+    commands = COMMANDS
+    if not args.host:
+        server_ctl = OutputController(username=args.username, password="admin")
+        ns = server.SSHServer(server_ctl, host_key="tests/host_key")
+        args.host, args.port, args.password = "127.0.0.1", ns.port, "admin"
+        commands = dict((kind, kind + " {}") for kind in COMMANDS)
+    size = args.size * 1024 * 1024
+
+    print("{:<20} {:>12} {:>14} {:>14}".format("profile", "connect ms", "text MB/s",
+                                               "binary MB/s"))
+    for profile in [None] + sorted(TRANSPORT_PROFILES):
+        connect = bench_connect(args, profile)
+        text = bench_output(args, profile, commands["text"], size)
+        binary = bench_output(args, profile, commands["binary"], size)
+        print("{:<20} {:>12.1f} {:>14.1f} {:>14.1f}".format(
+            str(profile or "default"), connect * 1000, text, binary))
+
+    if ns is not None:
+        ns.close()
+        ns.join()
+
+
+__author__ = 'Christian Hopps'
+__date__ = 'October 16 2026'
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
+
+
+if __name__ == "__main__":
+    main()
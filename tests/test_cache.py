@@ -18,9 +18,11 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+import threading
 import pytest
 
-from sshutil.cache import SSHConnectionCache, SSHNoConnectionCache
+from sshutil.cache import SSHAuthMemo, SSHConfigCache, SSHConnectionCache, SSHNoConnectionCache
 from sshutil.cmd import SSHCommand, SSHPTYCommand
 
 proxycmd = "ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null localhost /bin/nc %h %p"
@@ -41,6 +43,209 @@ def test_ok(cache, debug):
     assert output == "foobar\n"
 
 
+def test_config_cache(tmpdir):
+    path = tmpdir.join("config")
+    path.write("Host red\n  HostName red.example.com\n  Port 2222\n")
+    config = SSHConfigCache(str(path), check_interval=0)
+    assert config.lookup("red")["hostname"] == "red.example.com"
+    assert config.lookup("red")["port"] == "2222"
+    assert config.lookup("red") is config.lookup("red")
+
+    # Changes to the file are picked up.
+    path.write("Host red\n  HostName red.example.net\n")
+    assert config.lookup("red")["hostname"] == "red.example.net"
+    assert "port" not in config.lookup("red")
+
+    # A cache can have its own config.
+    cache = SSHConnectionCache("SSH config cache", ssh_config_path=str(path))
+    assert cache.ssh_config.lookup("red")["hostname"] == "red.example.net"
+
+    # A ProxyJump is used natively.
+    path.write("Host red\n  HostName red.example.net\n  ProxyJump admin@bastion:2022\n")
+    cache = SSHNoConnectionCache("SSH config cache", ssh_config_path=str(path))
+    jumphost, host, port = cache._config_jump_host("red", 22)
+    assert str(jumphost) == "admin@bastion:2022"
+    assert (host, port) == ("red.example.net", 22)
+
+
+def test_resolver_cache(monkeypatch):
+    import socket
+    from sshutil.cache import _connect_happy_eyeballs, SSHResolverCache
+
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(("127.0.0.1", 0))
+    listen.listen(1)
+    port = listen.getsockname()[1]
+
+    # Find a port nothing is listening on.
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(("127.0.0.1", 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+
+    refused = (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", closed_port))
+    good = (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))
+    lookups = []
+
+    def getaddrinfo(host, port, *args):
+        lookups.append(host)
+        return [refused, good]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    resolver = SSHResolverCache(ttl=60)
+    addrinfos = resolver.resolve("somehost", port)
+    assert addrinfos == [refused, good]
+    assert resolver.resolve("somehost", port) == [refused, good]
+    assert len(lookups) == 1
+
+    # The refused address fails fast and the next is tried without waiting the delay.
+    sock, addrinfo = _connect_happy_eyeballs(addrinfos, delay=30)
+    sock.close()
+    assert addrinfo == good
+
+    # The winner is tried first from now on.
+    resolver.connected("somehost", port, addrinfo)
+    assert resolver.resolve("somehost", port) == [good, refused]
+
+    # Only the most recent winners are remembered.
+    resolver = SSHResolverCache(ttl=60, max_winners=2)
+    for host in ("host1", "host2", "host1", "host3"):
+        resolver.connected(host, port, good)
+    assert list(resolver.winners) == [("host1", port), ("host3", port)]
+
+    # Subclasses can supply their own resolver and connect delay.
+    class Cache(SSHNoConnectionCache):
+        resolver = SSHResolverCache(ttl=60)
+        connect_delay = 30
+
+    sock = Cache.open_os_socket("otherhost", port, use_config=False)
+    sock.close()
+    assert ("otherhost", port) in Cache.resolver.resolved
+
+    with pytest.raises(socket.error):
+        _connect_happy_eyeballs([refused])
+    listen.close()
+
+
+def test_auth_memo_save(tmpdir, caplog):
+    path = str(tmpdir.join("auth-memo.json"))
+    memos = [SSHAuthMemo(path, save_delay=0), SSHAuthMemo(path, save_delay=0)]
+
+    def save(idx):
+        for port in range(0, 200):
+            memos[idx % 2].set("host{}".format(idx), port, "user", "password", None)
+
+    threads = [threading.Thread(target=save, args=(idx, )) for idx in range(0, 4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for memo in memos:
+        memo.save()
+    # Saves don't collide and whichever memo saved last the file is complete.
+    assert not [x for x in caplog.records if x.levelno >= logging.WARNING]
+    memo = SSHAuthMemo(path)
+    assert memo.get("host0", 199, "user") or memo.get("host1", 199, "user")
+    assert tmpdir.listdir() == [tmpdir.join("auth-memo.json")]
+
+
+def test_auth_memo_batch(tmpdir):
+    path = str(tmpdir.join("auth-memo.json"))
+    memo = SSHAuthMemo(path, save_delay=3600)
+    for port in range(0, 100):
+        memo.set("host", port, "user", "password", None)
+    # Nothing is written until the batch is saved.
+    assert not tmpdir.listdir()
+    memo.save()
+    assert SSHAuthMemo(path).get("host", 99, "user") == ("password", None)
+    assert memo.save_timer is None
+
+
+def test_adaptive_timeout():
+    from sshutil.cache import SSHAdaptiveTimeout
+
+    # One shard so that the order keys are forgotten in is that of all of them.
+    policy = SSHAdaptiveTimeout(min_timeout=.5, max_timeout=60, max_keys=2, shards=1)
+    # Keys not yet reused are closed early.
+    assert policy.timeout("once") == .5
+    policy.released("once", 0)
+    assert policy.timeout("once") == .5
+
+    # A key reused every 5 seconds is kept open long enough to be reused.
+    now = 0
+    for unused in range(0, 10):
+        policy.released("poll", now)
+        now += 5
+        policy.requested("poll", now)
+    assert 5 <= policy.timeout("poll") <= 10
+
+    # A key reused less often than the maximum is closed early.
+    policy.released("rare", 0)
+    policy.requested("rare", 600)
+    assert policy.timeout("rare") == .5
+
+    # Only the most recently used keys are remembered.
+    assert list(policy.shards[0].keys) == ["poll", "rare"]
+
+    # A key added early but still in use isn't the one forgotten.
+    policy.released("poll", now)
+    policy.released("new", now)
+    assert list(policy.shards[0].keys) == ["poll", "new"]
+    assert 5 <= policy.timeout("poll") <= 10
+
+    # Keys are spread over the shards, each remembering its share of max_keys.
+    policy = SSHAdaptiveTimeout(max_keys=64, shards=4)
+    for idx in range(0, 1000):
+        policy.released(("host{}".format(idx), 22), idx)
+    assert len(policy.shards) == 4
+    assert all(len(shard.keys) <= 16 for shard in policy.shards)
+    assert ("host999", 22) in policy._shard(("host999", 22)).keys
+
+
+def test_format_prometheus():
+    from sshutil.cache import format_prometheus
+
+    stats = SSHConnectionCache("test prometheus cache").stats()
+    key = dict(host="red", port=22, username="admin", proxycmd=None, profile=None, sockets=1,
+               channels=1, close_timeout=1)
+    stats["keys"] = [key, dict(key, proxycmd='admin@bastion:22 "a\\b"')]
+    # The same host reached through a jump host is a separate series.
+    lines = [x for x in format_prometheus(stats).splitlines() if x.startswith("sshutil_cache_key")]
+    assert len(lines) == len(set(x.rsplit(" ", 1)[0] for x in lines)) == 6
+    assert 'proxy="admin@bastion:22 \\"a\\\\b\\""' in lines[1]
+
+
+@pytest.mark.parametrize("timeout,phase_timeouts", [(.5, None), (None, {"handshake": .5})])
+def test_deadline(timeout, phase_timeouts):
+    import socket
+    import time
+    from sshutil.cache import SSHTimeoutError
+
+    # A server that accepts connections but never speaks SSH.
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(("127.0.0.1", 0))
+    listen.listen(1)
+    port = listen.getsockname()[1]
+
+    start = time.time()
+    with pytest.raises(SSHTimeoutError) as excinfo:
+        SSHCommand(
+            "ls",
+            "127.0.0.1",
+            port=port,
+            password="admin",
+            cache=SSHNoConnectionCache(),
+            timeout=timeout,
+            phase_timeouts=phase_timeouts)
+    assert excinfo.value.phase == "handshake"
+    assert time.time() - start < 5
+    listen.close()
+
+    with pytest.raises(ValueError):
+        SSHCommand("ls", "127.0.0.1", phase_timeouts={"foo": 1})
+
+
 # Failing for some reason
 # @pytest.mark.parametrize(
 #     "cache",
@@ -20,10 +20,23 @@ from __future__ import absolute_import, division, unicode_literals, print_functi
 import errno
 import getpass
 import logging
+import os
 import socket
-from sshutil.cache import SSHConnectionCache, SSHNoConnectionCache
+import subprocess
+import threading
+import time
+import paramiko as ssh
+import pytest
+from sshutil.cache import SSHAdaptiveTimeout, SSHAgentCache, SSHAuthMemo, SSHConnectionCache
+from sshutil.cache import SSHNoConnectionCache
+from sshutil.cache import SSHTimeoutError
+from sshutil.cache import format_prometheus, SSHJumpHost, TRANSPORT_PROFILES
+from sshutil.cmd import CalledProcessError, run_hosts, SSHCommand
+from sshutil.host import Host
+from sshutil.mux import SSHMuxCache, SSHMuxServer
 import sshutil.conn as conn
 import sshutil.server as server
+from testfunc import ExecController
 
 logger = logging.getLogger(__name__)
 ssh_server = None
@@ -82,6 +95,375 @@ def test_multi_session():
     logger.debug("Multi-session test complete")
 
 
+def test_parallel_open_cache():
+    cache = SSHConnectionCache("test parallel open cache", max_channels=8)
+    sessions = []
+    errors = []
+
+    def open_session():
+        try:
+            sessions.append(
+                conn.SSHSession(
+                    "127.0.0.1",
+                    password="admin",
+                    port=ssh_server.port,
+                    debug=CLIENT_DEBUG,
+                    cache=cache))
+        except Exception as error:  # pylint: disable=W0703
+            errors.append(error)
+
+    threads = [threading.Thread(target=open_session) for unused in range(0, 8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    # All concurrent requesters should have shared the single pending connect.
+    assert len(cache.ssh_socket_entries) == 1
+
+    for session in sessions:
+        session.close()
+    cache.flush()
+
+
+def test_idle_expire_cache():
+    cache = SSHConnectionCache("test idle expire cache", close_timeout=.2)
+    for unused in range(0, 5):
+        session = conn.SSHSession(
+            "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+        session.close()
+    # The socket is reused and kept open until it has been idle for close_timeout.
+    assert len(cache.ssh_socket_entries) == 1
+    time.sleep(.5)
+    assert not cache.ssh_socket_entries
+
+    # Reusing an idle socket doesn't grow the reaper's heap.
+    cache = SSHConnectionCache("test idle reuse cache", close_timeout=300)
+    for unused in range(0, 2000):
+        sshsock = cache.get_ssh_socket("127.0.0.1", ssh_server.port, getpass.getuser(), "admin",
+                                       False)
+        cache.release_ssh_socket(sshsock, False)
+    assert len(cache.reaper.live) == 1
+    assert len(cache.reaper.heap) == 1
+    cache.flush()
+    assert not cache.reaper.live
+
+    # A socket reused past its first deadline is kept until it has been idle for close_timeout.
+    cache = SSHConnectionCache("test idle extend cache", close_timeout=.3)
+    sshsock = cache.get_ssh_socket("127.0.0.1", ssh_server.port, getpass.getuser(), "admin", False)
+    cache.release_ssh_socket(sshsock, False)
+    for unused in range(0, 6):
+        time.sleep(.1)
+        assert cache.get_ssh_socket("127.0.0.1", ssh_server.port, getpass.getuser(), "admin",
+                                    False) is sshsock
+        cache.release_ssh_socket(sshsock, False)
+    assert cache.stats()["expirations"] == 0
+    assert _wait_for(lambda: not cache.ssh_socket_entries)
+
+
+class LimitedChannelController(server.SSHUserPassController):
+    """Refuse more than `max_channels` channels per connection."""
+
+    def __init__(self, max_channels, *args, **kwargs):
+        super(LimitedChannelController, self).__init__(*args, **kwargs)
+        self.max_channels = max_channels
+
+    def check_channel_request(self, kind, chanid):
+        if chanid >= self.max_channels:
+            return ssh.OPEN_FAILED_RESOURCE_SHORTAGE
+        return super(LimitedChannelController, self).check_channel_request(kind, chanid)
+
+
+def test_learn_max_channels_cache():
+    server_ctl = LimitedChannelController(3, username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test learn max channels cache", max_channels=8)
+
+    # The 4th channel is refused and the cache moves on to a new socket.
+    sessions = [
+        conn.SSHSession(
+            "127.0.0.1", password="admin", port=ns.port, debug=CLIENT_DEBUG, cache=cache)
+        for unused in range(0, 7)
+    ]
+    assert cache.host_max_channels[("127.0.0.1", ns.port)] == 3
+    assert len(cache.ssh_socket_entries) == 3
+    assert sorted(e.count for e in cache.ssh_socket_entries.values()) == [1, 3, 3]
+
+    for session in sessions:
+        session.close()
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
+def test_bounded_cache():
+    server_ctl = server.SSHUserPassController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache(
+        "test bounded cache", close_timeout=30, max_channels=1, max_sockets=1)
+
+    # Opening a socket to a second server evicts the unused socket to the first.
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    session.close()
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ns.port, debug=CLIENT_DEBUG, cache=cache)
+    assert [e.key[1] for e in cache.ssh_socket_entries.values()] == [ns.port]
+
+    # With every socket busy a new request waits for a release.
+    opened = []
+    thread = threading.Thread(target=lambda: opened.append(
+        conn.SSHSession(
+            "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG,
+            cache=cache)))
+    thread.start()
+    time.sleep(.5)
+    assert not opened
+    session.close()
+    thread.join()
+    assert [e.key[1] for e in cache.ssh_socket_entries.values()] == [ssh_server.port]
+    assert cache.stats()["waits"] == 1
+
+    # Waiting for a busy socket is bounded by the deadline.
+    with pytest.raises(SSHTimeoutError) as excinfo:
+        conn.SSHSession(
+            "127.0.0.1",
+            password="admin",
+            port=ns.port,
+            debug=CLIENT_DEBUG,
+            cache=cache,
+            phase_timeouts={"wait": .2})
+    assert excinfo.value.phase == "wait"
+
+    opened[0].close()
+    cache.flush()
+
+    # The least recently used unused socket is evicted first.
+    other_ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test lru cache", close_timeout=30, max_sockets=2)
+    sessions = [
+        conn.SSHSession(
+            "127.0.0.1", password="admin", port=port, debug=CLIENT_DEBUG, cache=cache)
+        for port in (ssh_server.port, ns.port)
+    ]
+    sessions[0].close()
+    sessions[1].close()
+    conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG,
+        cache=cache).close()
+    conn.SSHSession(
+        "127.0.0.1", password="admin", port=other_ns.port, debug=CLIENT_DEBUG,
+        cache=cache).close()
+    assert sorted(e.key[1] for e in cache.ssh_socket_entries.values()) == sorted(
+        [ssh_server.port, other_ns.port])
+    cache.flush()
+
+    other_ns.close()
+    other_ns.join()
+    ns.close()
+    ns.join()
+
+
+def _wait_for(predicate, timeout=5):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        time.sleep(.05)
+    return predicate()
+
+
+def test_spare_cache():
+    cache = SSHConnectionCache(
+        "test spare cache",
+        close_timeout=.2,
+        max_channels=4,
+        host_min_spares={("127.0.0.1", ssh_server.port): 1},
+        spare_threshold=.5)
+
+    def open_session():
+        return conn.SSHSession(
+            "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+
+    # Below the threshold no spare is opened.
+    sessions = [open_session()]
+    time.sleep(.2)
+    assert cache.stats()["spares"] == 0
+
+    # Crossing the threshold opens a spare in the background which isn't used until the busy
+    # socket is full.
+    sessions.append(open_session())
+    assert _wait_for(lambda: cache.stats()["sockets"] == 2)
+    assert cache.stats()["spares"] == 1
+    sessions.append(open_session())
+    sessions.append(open_session())
+    assert sorted(e.count for e in cache.ssh_socket_entries.values()) == [0, 4]
+
+    # The spare doesn't expire while the other socket is in use.
+    time.sleep(.5)
+    assert cache.stats()["sockets"] == 2
+
+    # A burst beyond the busy socket uses the spare without a handshake and a new spare is opened.
+    misses = cache.stats()["misses"]
+    sessions.append(open_session())
+    assert cache.stats()["misses"] == misses
+    assert _wait_for(lambda: cache.stats()["sockets"] == 3)
+
+    for session in sessions:
+        session.close()
+    assert _wait_for(lambda: cache.stats()["sockets"] == 0)
+
+
+def test_spare_cache_failed(monkeypatch):
+    cache = SSHConnectionCache(
+        "test failed spare cache", max_channels=2, min_spares=1, spare_threshold=.5)
+    open_ssh_socket = cache._open_ssh_socket
+    spare_started = threading.Event()
+    fail_spare = threading.Event()
+
+    def open_failing_spare(*args, **kwargs):
+        if threading.current_thread().name == "SSHCacheSpare":
+            spare_started.set()
+            fail_spare.wait()
+            raise ssh.SSHException("spare failed")
+        return open_ssh_socket(*args, **kwargs)
+
+    monkeypatch.setattr(cache, "_open_ssh_socket", open_failing_spare)
+
+    def open_session():
+        return conn.SSHSession(
+            "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+
+    sessions = [open_session()]
+    assert spare_started.wait(5)
+    sessions.append(open_session())
+
+    # A request waiting on the spare connects itself when the spare fails.
+    timer = threading.Timer(.2, fail_spare.set)
+    timer.start()
+    sessions.append(open_session())
+    timer.join()
+    assert sessions[2].ssh is not sessions[0].ssh
+    stats = cache.stats()
+    assert stats["connect_errors"] >= 1
+    assert stats["waits"] == 1
+
+    for session in sessions:
+        session.close()
+    cache.flush()
+
+
+def test_adaptive_timeout_cache():
+    policy = SSHAdaptiveTimeout(min_timeout=.1, max_timeout=5)
+    cache = SSHConnectionCache("test adaptive timeout cache", close_policy=policy)
+
+    def poll():
+        conn.SSHSession(
+            "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG,
+            cache=cache).close()
+
+    # Polling every .3 seconds outlasts the minimum timeout at first, once learned the socket is
+    # kept open between polls.
+    for unused in range(0, 6):
+        poll()
+        time.sleep(.3)
+    stats = cache.stats()
+    assert stats["sockets"] == 1
+    assert .3 <= stats["keys"][0]["close_timeout"] <= 5
+    hits = stats["hits"]
+    poll()
+    assert cache.stats()["hits"] == hits + 1
+    assert 0 < cache.stats()["hit_rate"] < 1
+    assert "sshutil_cache_hit_rate " in format_prometheus(cache.stats())
+    cache.flush()
+
+
+def test_prewarm_cache():
+    cache = SSHConnectionCache("test prewarm cache", close_timeout=30)
+
+    # Find a port with nothing listening on it.
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    closed_port = sock.getsockname()[1]
+    sock.close()
+
+    results = cache.prewarm(
+        ["127.0.0.1", dict(host="127.0.0.1", port=closed_port)],
+        port=ssh_server.port,
+        password="admin",
+        debug=CLIENT_DEBUG)
+    assert [r.port for r in results] == [ssh_server.port, closed_port]
+    assert results[0].error is None
+    assert isinstance(results[1].error, socket.error)
+    assert all(r.elapsed >= 0 for r in results)
+
+    # The prewarmed socket is used by the session.
+    sshsock = next(iter(cache.ssh_socket_entries))
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    assert session.ssh is sshsock
+    session.close()
+    cache.flush()
+
+
+def test_monitor_remote_close_cache():
+    server_ctl = server.SSHUserPassController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test monitor cache", close_timeout=30, monitor_interval=.1)
+
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ns.port, debug=CLIENT_DEBUG, cache=cache)
+    session.close()
+    assert len(cache.ssh_socket_entries) == 1
+
+    # The unused socket is closed in the background once the server goes away.
+    ns.close()
+    ns.join()
+    for unused in range(0, 20):
+        if not cache.ssh_socket_entries:
+            break
+        time.sleep(.1)
+    assert not cache.ssh_socket_entries
+
+
+def test_cache_stats():
+    cache = SSHConnectionCache("test stats cache", close_timeout=30)
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    session2 = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+    assert stats["sockets"] == 1
+    assert stats["channels"] == 2
+    assert stats["handshake_seconds"]["count"] == 1
+    assert stats["handshake_seconds"]["buckets"][-1][1] == 1
+    keys = [(k["port"], k["sockets"], k["channels"]) for k in stats["keys"]]
+    assert keys == [(ssh_server.port, 1, 2)]
+    assert "sshutil_cache_hits_total 1\n" in format_prometheus(stats)
+
+    session.close()
+    session2.close()
+    cache.flush()
+    assert cache.stats()["sockets"] == 0
+
+
+def test_auth_memo(tmpdir):
+    path = str(tmpdir.join("auth-memo.json"))
+    cache = SSHNoConnectionCache("test auth memo", auth_memo=SSHAuthMemo(path))
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    session.close()
+
+    # The working method is remembered and persisted.
+    username = getpass.getuser()
+    assert cache.auth_memo.get("127.0.0.1", ssh_server.port, username) == ("password", None)
+    cache.auth_memo.save()
+    assert SSHAuthMemo(path).get("127.0.0.1", ssh_server.port, username) == ("password", None)
+    assert SSHAuthMemo(path).get("127.0.0.1", ssh_server.port + 1, username) is None
+
+
 def _test_server_close(cache):
     server_ctl = server.SSHUserPassController(username=getpass.getuser(), password="admin")
     port = None
@@ -205,6 +587,585 @@ def test_multi_open_cache():
     _test_multi_open(SSHConnectionCache("test multi open cache"))
 
 
+def test_mux_cache(tmpdir):
+    server_ctl = ExecController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    path = str(tmpdir.join("mux"))
+    server_mux = SSHMuxServer(path, SSHConnectionCache("test mux cache", close_timeout=30))
+    cache = SSHMuxCache(path)
+
+    # Commands from "other processes" share the server's cached connection.
+    for unused in range(0, 3):
+        cmd = SSHCommand(
+            "echo foo; echo bar >&2; exit 3",
+            "127.0.0.1",
+            port=ns.port,
+            password="admin",
+            debug=CLIENT_DEBUG,
+            cache=cache)
+        assert cmd.run_status_stderr() == (3, "foo\n", "bar\n")
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+    # The server releases channels as it notices the clients closing.
+    for unused in range(0, 20):
+        if not stats["channels"]:
+            break
+        time.sleep(.1)
+        stats = cache.stats()
+    assert stats["channels"] == 0
+
+    # Batches run in parallel on the server's channels.
+    assert cache.channel_limit("127.0.0.1", ns.port) == 8
+    start = time.time()
+    results = SSHCommand.run_many(["sleep .5; echo ok"] * 8,
+                                  "127.0.0.1",
+                                  port=ns.port,
+                                  password="admin",
+                                  cache=cache)
+    assert time.time() - start < 2
+    assert [x.output for x in results] == ["ok\n"] * 8
+
+    # What is left of the deadline is passed to the server.
+    cmd = SSHCommand(
+        "true",
+        "127.0.0.1",
+        port=ns.port,
+        password="admin",
+        cache=cache,
+        timeout=30,
+        phase_timeouts=dict(wait=60, channel=10))
+    assert cmd.run_status() == (0, "")
+
+    # Errors are passed back to the client.
+    with pytest.raises(ssh.AuthenticationException):
+        SSHCommand("true", "127.0.0.1", port=ns.port, username="nobody", password="admin",
+                   cache=cache)
+
+    server_mux.close()
+    server_mux.join()
+    assert not os.path.exists(path)
+    ns.close()
+    ns.join()
+
+
+class ForwardController(server.SSHUserPassController):
+    """Also allow direct-tcpip forwarding."""
+
+    def __init__(self, *args, **kwargs):
+        super(ForwardController, self).__init__(*args, **kwargs)
+        self.destinations = {}
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "direct-tcpip":
+            return ssh.OPEN_SUCCEEDED
+        return super(ForwardController, self).check_channel_request(kind, chanid)
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return ssh.OPEN_SUCCEEDED
+
+
+class ForwardSession(server.SSHServerSession):
+    """Relay direct-tcpip channels to their destination."""
+
+    def __init__(self, stream, ssh_server, extra_args, debug):
+        super(ForwardSession, self).__init__(stream, ssh_server, extra_args, debug)
+        destination = ssh_server.server_ctl.destinations.pop(stream.get_id(), None)
+        if destination is not None:
+            sock = socket.create_connection(destination)
+            for src, dst in ((stream, sock), (sock, stream)):
+                thread = threading.Thread(target=self._relay, args=(src, dst))
+                thread.daemon = True
+                thread.start()
+
+    @staticmethod
+    def _relay(src, dst):
+        try:
+            data = src.recv(32 * 1024)
+            while data:
+                dst.sendall(data)
+                data = src.recv(32 * 1024)
+        except (socket.error, EOFError):
+            pass
+        dst.close()
+
+
+def test_jump_host_cache(monkeypatch):
+    assert str(SSHJumpHost.parse("a@b:2222,c")) == "a@b:2222,{}@c:22".format(getpass.getuser())
+    assert SSHJumpHost.parse("[::1]:2022").host == "::1"
+
+    server_ctl = ForwardController(username=getpass.getuser(), password="admin")
+    bastion = server.SSHServer(
+        server_ctl,
+        server_session_class=ForwardSession,
+        host_key="tests/host_key",
+        debug=SERVER_DEBUG)
+    server_ctl = server.SSHUserPassController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test jump host cache", close_timeout=30)
+    jumphost = SSHJumpHost("127.0.0.1", bastion.port, password="admin")
+
+    # Both targets are reached through one bastion transport.
+    sessions = [
+        conn.SSHSession(
+            "127.0.0.1",
+            password="admin",
+            port=port,
+            debug=CLIENT_DEBUG,
+            cache=cache,
+            proxycmd=jumphost) for port in (ssh_server.port, ns.port, ns.port)
+    ]
+    entries = cache.ssh_socket_entries.values()
+    assert sorted((e.key[1], e.count) for e in entries) == sorted([(bastion.port, 2),
+                                                                   (ssh_server.port, 1),
+                                                                   (ns.port, 2)])
+
+    for session in sessions:
+        session.close()
+    cache.flush()
+    cache.flush()
+    assert not cache.ssh_socket_entries
+
+    # The auth memo is keyed on the host asked for, not the one a ProxyJump reaches.
+    def config_jump_host(host, port):
+        if host == "target":
+            return jumphost, "127.0.0.1", ns.port
+        return None, host, port
+
+    cache = SSHNoConnectionCache("test jump host memo")
+    monkeypatch.setattr(cache, "_config_jump_host", config_jump_host)
+    conn.SSHSession("target", password="admin", debug=CLIENT_DEBUG, cache=cache).close()
+    assert cache.auth_memo.get("target", 22, getpass.getuser()) == ("password", None)
+    assert cache.auth_memo.get("127.0.0.1", ns.port, getpass.getuser()) is None
+
+    bastion.close()
+    bastion.join()
+    ns.close()
+    ns.join()
+
+
+def test_transport_profile_cache():
+    cache = SSHConnectionCache("test transport profile cache")
+    sessions = {}
+    for profile in (None, "low-latency", "bulk-throughput", "constrained-device"):
+        sessions[profile] = conn.SSHSession(
+            "127.0.0.1",
+            password="admin",
+            port=ssh_server.port,
+            debug=CLIENT_DEBUG,
+            cache=cache,
+            profile=profile)
+    # Each profile has its own socket.
+    assert len(cache.ssh_socket_entries) == 4
+    # The first preferred algorithm this paramiko supports is used.
+    for name in ("bulk-throughput", "constrained-device"):
+        sshsock = sessions[name].ssh
+        options = sshsock.get_security_options()
+        profile = TRANSPORT_PROFILES[name]
+        assert sshsock.local_cipher == [x for x in profile.ciphers if x in options.ciphers][0]
+    assert sessions["constrained-device"].ssh.local_mac == "hmac-sha2-256"
+    assert sessions["bulk-throughput"].chan.in_window_size == 16 * 1024 * 1024
+    assert sessions["constrained-device"].chan.in_max_packet_size == 16 * 1024
+    assert sorted(str(k["profile"]) for k in cache.stats()["keys"]) == [
+        "None", "bulk-throughput", "constrained-device", "low-latency"
+    ]
+
+    with pytest.raises(ValueError):
+        conn.SSHSession(
+            "127.0.0.1", password="admin", port=ssh_server.port, cache=cache, profile="foo")
+
+    for session in sessions.values():
+        session.close()
+    cache.flush()
+
+
+class PubkeyController(server.SSHUserPassController):
+    """Only allow public key auth with a given key."""
+
+    def __init__(self, username, key):
+        super(PubkeyController, self).__init__(username=username)
+        self.key = key
+
+    def get_allowed_auths(self, username):
+        del username  # unused
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if self.username == username and key.asbytes() == self.key.asbytes():
+            return ssh.AUTH_SUCCESSFUL
+        return ssh.AUTH_FAILED
+
+
+def test_agent_cache(tmpdir, monkeypatch):
+    try:
+        output = subprocess.check_output(["ssh-agent", "-s", "-a", str(tmpdir.join("agent"))])
+    except OSError:
+        pytest.skip("ssh-agent not available")
+    env = dict(line.split(";")[0].split("=") for line in output.decode().splitlines()
+               if line.startswith("SSH_"))
+    monkeypatch.setenv("SSH_AUTH_SOCK", env["SSH_AUTH_SOCK"])
+    try:
+        key = ssh.RSAKey.generate(bits=2048)
+        keyfile = str(tmpdir.join("id_rsa"))
+        key.write_private_key_file(keyfile)
+        subprocess.check_call(["ssh-add", "-q", keyfile], env=dict(os.environ))
+
+        server_ctl = PubkeyController(getpass.getuser(), key)
+        ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+        agent = SSHAgentCache()
+        cache = SSHNoConnectionCache("test agent cache", ssh_agent=agent)
+        sessions = []
+        errors = []
+
+        def open_session():
+            try:
+                sessions.append(conn.SSHSession("127.0.0.1", port=ns.port, cache=cache))
+            except Exception as error:  # pylint: disable=W0703
+                errors.append(error)
+
+        # Concurrent handshakes share the one agent connection.
+        threads = [threading.Thread(target=open_session) for unused in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(sessions) == 8
+        shared = agent.agent
+        assert shared is not None
+        for session in sessions:
+            session.close()
+
+        # A failed agent is replaced on next use.
+        agent.failed(agent.get_keys()[0])
+        assert agent.agent is None
+        conn.SSHSession("127.0.0.1", port=ns.port, cache=cache).close()
+        assert agent.agent is not None and agent.agent is not shared
+
+        # Keys listed before the connection was refreshed sign through the new one.
+        stale = agent.get_keys()[0]
+        agent.expire = 0
+        agent.get_keys()
+        assert stale.agent is not agent.agent
+        assert stale.sign_ssh_data(b"data")
+        assert stale.agent is agent.agent
+
+        agent.close()
+        ns.close()
+        ns.join()
+    finally:
+        subprocess.call(["ssh-agent", "-k"],
+                        env=dict(os.environ, SSH_AGENT_PID=env["SSH_AGENT_PID"]))
+
+
+def test_fork_cache():
+    cache = SSHConnectionCache("test fork cache", close_timeout=30)
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    parent_sock = session.ssh
+
+    pid = os.fork()
+    if pid == 0:
+        # The child starts with an empty cache and makes its own connections.
+        status = 1
+        try:
+            if cache.stats()["sockets"] == 0 and not parent_sock.is_active():
+                child = conn.SSHSession(
+                    "127.0.0.1", password="admin", port=ssh_server.port, cache=cache)
+                if child.ssh is not parent_sock and cache.stats()["misses"] == 1:
+                    status = 0
+                child.close()
+                cache.flush()
+                # Releasing the socket inherited from the parent just drops it.
+                session.close()
+        except Exception:
+            status = 1
+        finally:
+            os._exit(status)  # pylint: disable=W0212
+    unused, status = os.waitpid(pid, 0)
+    assert status == 0
+
+    # The parent's connection is undisturbed.
+    assert parent_sock.is_active()
+    other = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    assert other.ssh is parent_sock
+    other.close()
+    session.close()
+    cache.flush()
+
+
+def test_fork_nocache():
+    cache = SSHNoConnectionCache("test fork nocache")
+    session = conn.SSHSession(
+        "127.0.0.1", password="admin", port=ssh_server.port, debug=CLIENT_DEBUG, cache=cache)
+    parent_sock = session.ssh
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            session.close()
+            if not parent_sock.is_active() and cache.stats()["sockets"] == 0:
+                status = 0
+        except Exception:
+            status = 1
+        finally:
+            os._exit(status)  # pylint: disable=W0212
+    unused, status = os.waitpid(pid, 0)
+    assert status == 0
+
+    assert parent_sock.is_active()
+    assert cache.stats()["sockets"] == 1
+    session.close()
+    assert cache.stats()["sockets"] == 0
+
+
+def test_stream_cmd():
+    server_ctl = ExecController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test stream cache", close_timeout=30)
+
+    def command(text):
+        return SSHCommand(
+            text, "127.0.0.1", port=ns.port, password="admin", debug=CLIENT_DEBUG, cache=cache)
+
+    # More output on each stream than the channel window; the server sends all of stdout before
+    # any stderr so reading one before the other (or waiting for the exit status) would stall.
+    big = "head -c 8000000 /dev/zero; head -c 3000000 /dev/zero >&2; exit 3"
+    sizes = {"stdout": 0, "stderr": 0}
+    cmd = command(big)
+    for name, data in cmd.stream():
+        assert len(data) <= conn.MAXSSHBUF
+        sizes[name] += len(data)
+    assert sizes == {"stdout": 8000000, "stderr": 3000000}
+    assert cmd.exit_code == 3
+
+    status, output, error = command(big).run_status_stderr()
+    assert (status, len(output), len(error)) == (3, 8000000, 3000000)
+
+    lines = []
+    cmd = command("seq 1 100000; printf err >&2")
+    assert cmd.run_status_callback(lines.append, lines.append, lines=True) == 0
+    assert lines[:-1] == ["{}\n".format(i).encode('utf-8') for i in range(1, 100001)]
+    assert lines[-1] == b"err"
+
+    # Waiting for output is limited by the channel's timeout.
+    cmd = command("sleep 1")
+    cmd.chan.settimeout(.2)
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        cmd.run()
+    assert time.time() - start < 1
+
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
+def test_bytes_cmd(tmpdir):
+    server_ctl = ExecController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test bytes cache", close_timeout=30)
+
+    def command(text, encoding="utf-8"):
+        return SSHCommand(
+            text,
+            "127.0.0.1",
+            port=ns.port,
+            password="admin",
+            debug=CLIENT_DEBUG,
+            cache=cache,
+            encoding=encoding)
+
+    # Binary output comes back untouched.
+    payload = os.urandom(1000000)
+    path = tmpdir.join("payload")
+    path.write_binary(payload)
+    assert command("cat " + str(path), None).run() == payload
+    assert command("cat {} >&2".format(path), None).run_stderr() == (b"", payload)
+
+    # An odd offset splits the 2 byte characters across chunk boundaries.
+    text = "x" + "\u00e9" * 500000
+    path.write_binary(text.encode('utf-8'))
+    assert command("cat " + str(path)).run() == text
+    assert command("cat " + str(path), "latin-1").run() == text.encode('utf-8').decode('latin-1')
+
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
+def test_spool_cmd(tmpdir):
+    server_ctl = ExecController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test spool cache", close_timeout=30)
+
+    payload = os.urandom(3000000)
+    path = tmpdir.join("payload")
+    path.write_binary(payload)
+    cmd = SSHCommand(
+        "cat {}; echo small >&2; exit 3".format(path),
+        "127.0.0.1",
+        port=ns.port,
+        password="admin",
+        debug=CLIENT_DEBUG,
+        cache=cache,
+        spool_size=1000000)
+    status, output, error = cmd.run_status_stderr()
+    with output, error:
+        assert status == 3
+        assert len(output) == len(payload)
+        assert output.mmap()[:] == payload
+        assert output.file.read(10) == payload[:10]
+        assert error.getvalue() == b"small\n"
+        assert error.mmap()[:] == b"small\n"
+
+    # Failures carry the spooled output.
+    with pytest.raises(CalledProcessError) as excinfo:
+        cmd = SSHCommand(
+            "echo out; exit 1",
+            "127.0.0.1",
+            port=ns.port,
+            password="admin",
+            cache=cache,
+            spool_size=10)
+        cmd.run()
+    assert excinfo.value.output.getvalue() == b"out\n"
+    assert excinfo.value.stderr.mmap() == b""
+
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
+def test_run_many_cmd():
+    server_ctl = ExecController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test run many cache", close_timeout=30, max_channels=10)
+
+    # The commands share one socket and run 10 at a time.
+    commands = ["sleep .5; echo {}; exit {}".format(i, i % 2) for i in range(0, 20)]
+    start = time.time()
+    results = SSHCommand.run_many(
+        commands, "127.0.0.1", port=ns.port, password="admin", debug=CLIENT_DEBUG, cache=cache)
+    assert time.time() - start < 4
+    assert [x.command for x in results] == commands
+    assert [(x.status, x.output, x.error_output, x.exception) for x in results] == [
+        (i % 2, "{}\n".format(i), "", None) for i in range(0, 20)
+    ]
+    assert all(x.elapsed >= .5 for x in results)
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["sockets"] == 1
+
+    # Failures are returned not raised.
+    results = SSHCommand.run_many(["true", "true"],
+                                  "127.0.0.1",
+                                  port=ns.port,
+                                  username="nobody",
+                                  password="admin",
+                                  cache=cache)
+    assert all(isinstance(x.exception, ssh.AuthenticationException) for x in results)
+    assert all(x.status is None for x in results)
+
+    # Without a cache each command has its own connection and they still run in parallel.
+    start = time.time()
+    results = SSHCommand.run_many(
+        commands[:8],
+        "127.0.0.1",
+        port=ns.port,
+        password="admin",
+        debug=CLIENT_DEBUG,
+        cache=SSHNoConnectionCache("test run many no cache"))
+    assert time.time() - start < 2
+    assert [x.status for x in results] == [i % 2 for i in range(0, 8)]
+
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
+def test_run_hosts_cmd():
+    server_ctl = ExecController(username=getpass.getuser(), password="admin")
+    ns = server.SSHServer(server_ctl, host_key="tests/host_key", debug=SERVER_DEBUG)
+    cache = SSHConnectionCache("test run hosts cache", close_timeout=30)
+    hosts = ["127.0.0.1"] * 6 + [dict(host="127.0.0.1", username="nobody"), Host()]
+
+    def run(command, **kwargs):
+        return list(
+            run_hosts(
+                hosts,
+                command,
+                concurrency=4,
+                port=ns.port,
+                password="admin",
+                debug=CLIENT_DEBUG,
+                cache=cache,
+                **kwargs))
+
+    results = run("echo ok")
+    assert len(results) == len(hosts)
+    assert sorted(str(x.host) for x in results) == sorted(str(x) for x in hosts)
+    for result in results:
+        if isinstance(result.host, dict):
+            assert isinstance(result.exception, ssh.AuthenticationException)
+        else:
+            assert (result.status, result.output, result.exception) == (0, "ok\n", None)
+
+    # Later hosts finish first but are returned in order.
+    class DelayedHost(Host):
+        finished = []
+
+        def __init__(self, delay, **kwargs):
+            self.delay = delay
+            super(DelayedHost, self).__init__(**kwargs)
+
+        def run_status_stderr(self, command, timeout=None):
+            result = super(DelayedHost, self).run_status_stderr(
+                "sleep {}; {}".format(self.delay, command), timeout=timeout)
+            self.finished.append(self)
+            return result
+
+    delayed = [
+        DelayedHost(.1 * (4 - idx), server="127.0.0.1", port=ns.port, password="admin", cache=cache)
+        for idx in range(0, 4)
+    ]
+    results = list(run_hosts(delayed, "echo ok", concurrency=4, ordered=True))
+    assert DelayedHost.finished != delayed
+    assert [x.host for x in results] == delayed
+    assert all((x.status, x.output) == (0, "ok\n") for x in results)
+
+    # Hosts still running at the deadline time out.
+    start = time.time()
+    results = run("sleep 3", timeout=.5)
+    assert time.time() - start < 2
+    assert len(results) == len(hosts)
+    assert all(isinstance(x.exception, SSHTimeoutError) for x in results)
+    assert sum(x.exception.phase == "command" for x in results) >= 6
+
+    # Host objects are given the time left and none are started after the deadline.
+    class SlowHost(object):
+        timeouts = []
+
+        def run_status_stderr(self, command, timeout=None):
+            self.timeouts.append(timeout)
+            time.sleep(.3)
+            return 0, command, ""
+
+    results = list(run_hosts([SlowHost()] * 3, "ok", concurrency=1, timeout=.5))
+    assert [x.status for x in results] == [0, None, None]
+    time.sleep(.5)
+    assert len(SlowHost.timeouts) == 2
+    assert .4 < SlowHost.timeouts[0] <= .5
+    assert 0 < SlowHost.timeouts[1] < .3
+
+    cache.flush()
+    ns.close()
+    ns.join()
+
+
 __author__ = 'Christian Hopps'
 __date__ = 'February 17 2015'
 __version__ = '1.0'
@@ -18,7 +18,38 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import subprocess
+import threading
 from sshutil.cmd import CalledProcessError
+import sshutil.server as server
+
+
+class ExecController(server.SSHUserPassController):
+    """Also execute commands in a local shell.
+
+    Subclasses may override `_exec` to produce the output of a command some other way.
+    """
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._run, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _run(self, channel, command):
+        status = self._exec(channel, command)
+        # Leave closing to the client, a close could overtake the reply to the exec request.
+        channel.shutdown_write()
+        channel.send_exit_status(status)
+
+    def _exec(self, channel, command):
+        """Send the output of `command` on `channel` returning its exit status."""
+        proc = subprocess.Popen(
+            command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = proc.communicate()
+        channel.sendall(output)
+        channel.sendall_stderr(error)
+        return proc.returncode
 
 
 def _run_variations(runnable):